@@ -0,0 +1,185 @@
+"""
+Persistent on-disk caches which outlive a single job.
+"""
+import hashlib
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+
+
+def hash_key(*parts):
+    """Return a hex digest identifying the given str or bytes parts."""
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode()
+        # Prefix each part with its length so that parts cannot run together.
+        digest.update(f"{len(part)}:".encode())
+        digest.update(part)
+    return digest.hexdigest()
+
+
+class DiskCache:
+    """
+    A directory of cache entries, each of which is a directory named by its
+    key and holding one or more files. When the total size of the entries
+    exceeds max_bytes the least recently used entries are evicted.
+    The total is scanned once and then kept up to date with the entries this
+    object stores, so the directory is only scanned again when the total
+    goes over max_bytes. Entries stored by other processes are counted at
+    that next scan.
+    """
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._total = None
+        os.makedirs(self.path, exist_ok=True)
+
+    def _entry(self, key):
+        return os.path.join(self.path, key)
+
+    def get(self, key):
+        """
+        Return a dictionary mapping the names of the files stored under key
+        to their paths, or None if key is not in the cache.
+        """
+        entry = self._entry(key)
+        try:
+            names = os.listdir(entry)
+            # The modification time of an entry records its last use.
+            os.utime(entry)
+        except FileNotFoundError:
+            return None
+        return {name: os.path.join(entry, name) for name in names}
+
+    def put(self, key, files):
+        """
+        Store copies of files, a dictionary mapping names to paths, under key.
+        Entries are written to a temporary directory first so that readers
+        never see a partial entry.
+        """
+        entry = self._entry(key)
+        if os.path.exists(entry):
+            return
+        tmp = tempfile.mkdtemp(dir=self.path, prefix=".tmp-")
+        try:
+            for name, src in files.items():
+                shutil.copyfile(src, os.path.join(tmp, name))
+            size = self._size(tmp)
+            os.rename(tmp, entry)
+        except OSError:
+            # Another writer stored the same entry first.
+            shutil.rmtree(tmp, ignore_errors=True)
+            return
+        with self._lock:
+            if self._total is not None:
+                self._total += size
+            over = self._total is None or self._total > self.max_bytes
+        if over:
+            self.evict()
+
+    def _size(self, entry):
+        total = 0
+        for name in os.listdir(entry):
+            total += os.path.getsize(os.path.join(entry, name))
+        return total
+
+    def evict(self):
+        """Remove least recently used entries until under max_bytes."""
+        with self._lock:
+            entries = []
+            for key in os.listdir(self.path):
+                entry = self._entry(key)
+                if key.startswith(".") or not os.path.isdir(entry):
+                    continue
+                try:
+                    stat = os.stat(entry)
+                    entries.append((stat.st_mtime, self._size(entry), entry))
+                except FileNotFoundError:
+                    continue
+            total = sum(size for _, size, _ in entries)
+            for _, size, entry in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                logging.info(f"Evicting cache entry {entry}")
+                shutil.rmtree(entry, ignore_errors=True)
+                total -= size
+            self._total = total
+
+
+class PackCache:
+    """
+    A cache of many small entries, each a bytes value stored under a key,
+    packed into a single SQLite file rather than a file per entry. When
+    the total size of the values exceeds max_bytes the least recently used
+    entries are evicted.
+    The file is opened in SQLite's WAL mode, whose locking relies on memory
+    shared by the processes using it, so it must be on a local file system:
+    WAL mode does not work on network or shared volumes such as NFS, where
+    concurrent jobs could corrupt the file.
+    """
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Jobs running at the same time may share the file.
+        self._db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, value BLOB, size INTEGER, used REAL)"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS entries_used ON entries (used)"
+            )
+
+    def get(self, key):
+        """Return the value stored under key, or None."""
+        with self._lock, self._db:
+            row = self._db.execute(
+                "SELECT value FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            self._db.execute(
+                "UPDATE entries SET used = ? WHERE key = ?", (time.time(), key)
+            )
+        return row[0]
+
+    def put(self, key, value):
+        """Store value, a bytes object, under key."""
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR IGNORE INTO entries VALUES (?, ?, ?, ?)",
+                (key, value, len(value), time.time()),
+            )
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until under max_bytes."""
+        with self._lock, self._db:
+            total = self._db.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM entries"
+            ).fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            rows = self._db.execute(
+                "SELECT key, size FROM entries ORDER BY used"
+            ).fetchall()
+            evicted = []
+            for key, size in rows:
+                if total <= self.max_bytes:
+                    break
+                evicted.append((key,))
+                total -= size
+            logging.info(f"Evicting {len(evicted)} entries from {self.path}")
+            self._db.executemany("DELETE FROM entries WHERE key = ?", evicted)
@@ -0,0 +1,89 @@
+"""
+A durable record of the dockings a job has completed, so that a job which
+was interrupted can be run again and continue where it stopped.
+"""
+import json
+import logging
+import os
+import threading
+
+
+class CheckpointManifest:
+    """
+    An append-only journal of completed dockings. Each record is one JSON
+    line appended with a single write and synced to disk before the
+    docking is reported as done, so a crash can at worst leave a partial
+    last line, which is ignored when the manifest is loaded.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.completed = {}
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return
+        if lines and not lines[-1].endswith("\n"):
+            # Drop a record that was cut short so the next one starts on a
+            # line of its own.
+            logging.warning(f"Ignoring partial record in {self.path}")
+            lines.pop()
+            tmp = f"{self.path}.tmp"
+            with open(tmp, "w") as f:
+                f.writelines(lines)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                logging.warning(f"Ignoring partial record in {self.path}")
+                continue
+            self.completed[record["key"]] = record
+        logging.info(
+            f"Resuming with {len(self.completed)} completed dockings from "
+            f"{self.path}."
+        )
+
+    def get(self, key):
+        """
+        Return the record of a completed docking whose files still exist, or
+        None.
+        """
+        record = self.completed.get(key)
+        if record is None:
+            return None
+        directory = os.path.dirname(self.path)
+        paths = [os.path.join(directory, path) for path in record["files"]]
+        if not all(os.path.exists(path) for path in paths):
+            return None
+        return dict(record, paths=paths)
+
+    def record(self, key, *paths, **data):
+        """
+        Durably record a completed docking and the files it produced.
+        Paths are stored relative to the directory of the manifest.
+        """
+        directory = os.path.dirname(self.path)
+        record = dict(
+            data,
+            key=key,
+            files=[os.path.relpath(path, directory) for path in paths],
+        )
+        line = (json.dumps(record) + "\n").encode()
+        with self._lock:
+            fd = os.open(
+                self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644
+            )
+            try:
+                os.write(fd, line)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            self.completed[key] = record
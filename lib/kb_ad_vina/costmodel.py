@@ -0,0 +1,108 @@
+"""
+A model of the runtime of a docking, used to dock the most expensive
+ligands first so that no long docking is left running alone at the end.
+"""
+import json
+import logging
+import os
+import threading
+
+import numpy as np
+
+# The features of a docking, each entering the model as its logarithm.
+FEATURES = ("torsions", "heavy_atoms", "box_volume", "exhaustiveness", "cpu")
+
+# The runtime of vina grows with the flexibility and size of the ligand and
+# the exhaustiveness of the search, and shrinks with the cpus it is given.
+PRIOR = np.array([0.0, 1.0, 1.0, 0.3, 1.0, -0.7])
+
+
+def design_matrix(features):
+    """
+    Return the design matrix of the model for a dictionary of arrays, one
+    entry per docking, with the FEATURES as keys.
+    """
+    columns = [np.ones(len(features["torsions"]))]
+    for name in FEATURES:
+        values = np.asarray(features[name], dtype=float)
+        # One is added so that rigid ligands have a finite cost.
+        columns.append(np.log1p(np.maximum(values, 0)))
+    return np.stack(columns, axis=1)
+
+
+class CostModel:
+    """
+    A log-linear model of the runtime of a docking in seconds, fitted to the
+    runtimes observed in earlier jobs by least squares regularized towards
+    PRIOR, so that it gives a sensible ordering before any observation.
+    Observations are stored in a JSON file at path, if given, to be shared
+    between jobs.
+    """
+
+    def __init__(self, path=None, max_observations=2000, regularization=1.0):
+        self.path = path
+        self.max_observations = max_observations
+        self.regularization = regularization
+        self.observations = []
+        self._new = []
+        self._lock = threading.Lock()
+        if path:
+            self.observations = self._load()
+        self.coefficients = self.fit(self.observations)
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return []
+        except ValueError:
+            logging.warning(f"Ignoring unreadable cost model {self.path}")
+            return []
+
+    def fit(self, observations):
+        """Return the coefficients fitted to a list of observations."""
+        if not observations:
+            return PRIOR
+        features = {
+            name: [observation[name] for observation in observations]
+            for name in FEATURES
+        }
+        x = design_matrix(features)
+        y = np.log([observation["seconds"] for observation in observations])
+        penalty = self.regularization * np.eye(len(PRIOR))
+        return np.linalg.solve(
+            x.T @ x + penalty, x.T @ y + penalty @ PRIOR
+        )
+
+    def predict(self, features):
+        """
+        Return the predicted runtimes in seconds of the dockings described
+        by a dictionary of arrays with the FEATURES as keys.
+        """
+        return np.exp(design_matrix(features) @ self.coefficients)
+
+    def observe(self, seconds, **features):
+        """Record the runtime of a docking with the given FEATURES."""
+        if seconds <= 0:
+            return
+        with self._lock:
+            self._new.append(dict(features, seconds=seconds))
+
+    def save(self):
+        """
+        Add the new observations to those stored at path, keeping the most
+        recent max_observations, and refit the model.
+        """
+        with self._lock:
+            new, self._new = self._new, []
+        if self.path:
+            observations = (self._load() + new)[-self.max_observations :]
+            tmp = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(observations, f)
+            os.replace(tmp, self.path)
+        else:
+            observations = self.observations + new
+        self.observations = observations
+        self.coefficients = self.fit(observations)
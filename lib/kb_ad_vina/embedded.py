@@ -0,0 +1,128 @@
+"""
+Docking with the vina Python package (AutoDock Vina 1.2) in this process
+instead of starting the vina command for each ligand.
+
+Each thread keeps its engines, Vina objects with a receptor and the grid
+maps of a search box loaded, for the life of the process, and docks ligands
+from PDBQT strings against them, so that the receptor is parsed and its
+maps computed once per thread rather than once per ligand.
+"""
+import os
+import tempfile
+import threading
+
+try:
+    import vina as vina_package
+    from vina import Vina
+except ImportError:
+    vina_package = Vina = None
+
+# The engines of each thread by receptor, search box, cpus, seed and scoring
+# function.
+_engines = threading.local()
+
+
+def available():
+    """Return whether the vina Python package is installed."""
+    return Vina is not None
+
+
+def version():
+    """Return the version of the vina Python package, or None."""
+    if Vina is None:
+        return None
+    return getattr(vina_package, "__version__", None)
+
+
+def engine(receptor, search, cpu=None, scoring="vina"):
+    """
+    Return the engine of this thread for a receptor PDBQT filename, the
+    search parameters of search_parameters and a scoring function, creating
+    it if needed.
+    """
+    box = tuple(
+        search[name]
+        for name in ("center_x", "center_y", "center_z")
+        + ("size_x", "size_y", "size_z")
+    )
+    key = (receptor, box, cpu or 0, search["seed"], scoring)
+    engines = getattr(_engines, "engines", None)
+    if engines is None:
+        engines = _engines.engines = {}
+    if key not in engines:
+        vina = Vina(
+            sf_name=scoring, cpu=cpu or 0, seed=search["seed"], verbosity=0
+        )
+        vina.set_receptor(receptor)
+        # Maps computed before a ligand is set cover every atom type.
+        vina.compute_vina_maps(center=list(box[:3]), box_size=list(box[3:]))
+        engines[key] = vina
+    return engines[key]
+
+
+def dock(receptor, ligand_pdbqt, search, cpu=None, scoring="vina"):
+    """
+    Dock a ligand, given as the contents of a PDBQT file, to a receptor
+    PDBQT filename with the search parameters of search_parameters and a
+    scoring function.
+    Returns a dictionary with the output PDBQT contents as poses and the
+    binding modes as modes, like parse_vina_log.
+    """
+    vina = engine(receptor, search, cpu, scoring)
+    vina.set_ligand_from_string(ligand_pdbqt)
+    vina.dock(
+        exhaustiveness=search["exhaustiveness"],
+        n_poses=search["num_modes"],
+    )
+    poses = vina.poses(
+        n_poses=search["num_modes"], energy_range=search["energy_range"]
+    )
+    return dict(poses=poses, modes=pose_modes(poses))
+
+
+def score(
+    receptor, ligand_pdbqt, search, cpu=None, scoring="vina", mode=None
+):
+    """
+    Score a ligand pose, given as the contents of a PDBQT file, against a
+    receptor PDBQT filename without a search, after minimizing its energy
+    locally with the "local_only" mode. Returns a dictionary like dock with
+    the scored pose as poses and its affinity as the only mode.
+    """
+    vina = engine(receptor, search, cpu, scoring)
+    vina.set_ligand_from_string(ligand_pdbqt)
+    if mode == "local_only":
+        energies = vina.optimize()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "pose.pdbqt")
+            vina.write_pose(path)
+            with open(path) as f:
+                poses = f.read()
+    else:
+        energies = vina.score()
+        poses = ligand_pdbqt
+    affinity = float(energies[0])
+    return dict(
+        poses=poses,
+        modes=[dict(mode=1, affinity=affinity, rmsd_lb=0.0, rmsd_ub=0.0)],
+    )
+
+
+def pose_modes(poses):
+    """
+    Return the binding modes of the contents of a vina output PDBQT file,
+    from the VINA RESULT remark of each pose, like parse_vina_log.
+    """
+    modes = []
+    for line in poses.splitlines():
+        if line.startswith("REMARK VINA RESULT:"):
+            affinity, rmsd_lb, rmsd_ub = map(float, line.split()[3:6])
+            modes.append(
+                dict(
+                    mode=len(modes) + 1,
+                    affinity=affinity,
+                    rmsd_lb=rmsd_lb,
+                    rmsd_ub=rmsd_ub,
+                )
+            )
+    return modes
@@ -0,0 +1,240 @@
+"""
+Timing and resource instrumentation for the stages of a docking job.
+
+Each measurement records the wall time, the CPU time of the calling thread,
+the bytes it read and wrote, and the CPU time, peak resident set size and
+bytes read and written of the child processes it waited for with
+wait_child.
+"""
+import contextlib
+import json
+import logging
+import os
+import signal
+import subprocess
+import threading
+import time
+
+# The innermost measurement of each thread.
+_current = threading.local()
+
+CHILD_FIELDS = (
+    "child_cpu_seconds",
+    "child_bytes_read",
+    "child_bytes_written",
+)
+
+
+def read_io(path):
+    """Return the bytes read and written according to a /proc io file."""
+    counters = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                counters[name] = int(value)
+    except (OSError, ValueError):
+        pass
+    return counters.get("rchar", 0), counters.get("wchar", 0)
+
+
+def thread_io():
+    """Return the bytes read and written by the calling thread."""
+    return read_io(f"/proc/self/task/{threading.get_native_id()}/io")
+
+
+def exit_code(status):
+    """Convert a wait status into a Popen style return code."""
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def wait_child(proc):
+    """
+    Wait for the child process of a Popen object to exit, reap it and add
+    its resource usage, including the usage of the processes it waited
+    for, to the current measurement of this thread. Returns the exit code.
+    """
+    bytes_read, bytes_written = 0, 0
+    try:
+        # Leave the child a zombie until its io counters have been read.
+        os.waitid(os.P_PID, proc.pid, os.WEXITED | os.WNOWAIT)
+        bytes_read, bytes_written = read_io(f"/proc/{proc.pid}/io")
+        _, status, usage = os.wait4(proc.pid, 0)
+    except ChildProcessError:
+        # The child was already reaped elsewhere.
+        return proc.wait()
+    proc.returncode = exit_code(status)
+    add_child_usage(
+        child_cpu_seconds=usage.ru_utime + usage.ru_stime,
+        child_peak_rss_kb=usage.ru_maxrss,
+        child_bytes_read=bytes_read,
+        child_bytes_written=bytes_written,
+    )
+    return proc.returncode
+
+
+def measurement():
+    """Return the current measurement of this thread, or None."""
+    return getattr(_current, "record", None)
+
+
+def add_child_usage(**usage):
+    """
+    Add the resource usage of child processes, given as CHILD_FIELDS and
+    child_peak_rss_kb, to the current measurement of this thread, if any.
+    Returns the measurement.
+    """
+    record = getattr(_current, "record", None)
+    if record is not None:
+        for field in CHILD_FIELDS:
+            record[field] += usage.get(field, 0)
+        record["child_peak_rss_kb"] = max(
+            record["child_peak_rss_kb"], usage.get("child_peak_rss_kb", 0)
+        )
+    return record
+
+
+def kill(proc):
+    """
+    Kill a child process, and its process group if it leads one, so that
+    the commands run by a shell are killed too.
+    """
+    try:
+        if os.getpgid(proc.pid) == proc.pid:
+            os.killpg(proc.pid, signal.SIGKILL)
+        else:
+            proc.kill()
+    except ProcessLookupError:
+        pass
+
+
+def communicate(proc, timeout=None):
+    """
+    Read the output of a Popen object like Popen.communicate and reap the
+    child with wait_child. Returns a tuple (stdout, stderr). If the child
+    runs longer than timeout seconds it is killed and
+    subprocess.TimeoutExpired is raised.
+    """
+    timer = None
+    timed_out = threading.Event()
+    if timeout:
+
+        def expire():
+            timed_out.set()
+            kill(proc)
+
+        timer = threading.Timer(timeout, expire)
+        timer.start()
+    stderr = []
+    reader = None
+    if proc.stderr is not None:
+        reader = threading.Thread(
+            target=lambda: stderr.append(proc.stderr.read())
+        )
+        reader.start()
+    stdout = proc.stdout.read() if proc.stdout is not None else None
+    if reader is not None:
+        reader.join()
+    wait_child(proc)
+    if timer is not None:
+        timer.cancel()
+    if timed_out.is_set():
+        raise subprocess.TimeoutExpired(proc.args, timeout, stdout)
+    return stdout, (stderr[0] if stderr else None)
+
+
+class Instrumentation:
+    """Collects measurements of the stages of a job from any thread."""
+
+    def __init__(self):
+        self.records = []
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def measure(self, stage, ligand=None):
+        """
+        Measure the body of a with statement as a stage, optionally for a
+        ligand. The usage of child processes is added to the enclosing
+        measurement too.
+        """
+        record = dict(
+            stage=stage,
+            ligand=ligand,
+            child_cpu_seconds=0.0,
+            child_peak_rss_kb=0,
+            child_bytes_read=0,
+            child_bytes_written=0,
+        )
+        parent = getattr(_current, "record", None)
+        _current.record = record
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        bytes_read, bytes_written = thread_io()
+        try:
+            yield record
+        finally:
+            end_read, end_written = thread_io()
+            record.update(
+                wall_seconds=time.perf_counter() - wall,
+                cpu_seconds=time.thread_time() - cpu,
+                bytes_read=end_read - bytes_read,
+                bytes_written=end_written - bytes_written,
+            )
+            _current.record = parent
+            if parent is not None:
+                for field in CHILD_FIELDS:
+                    parent[field] += record[field]
+                parent["child_peak_rss_kb"] = max(
+                    parent["child_peak_rss_kb"], record["child_peak_rss_kb"]
+                )
+            with self._lock:
+                self.records.append(record)
+
+    def summary(self):
+        """Return the totals of the measurements of each stage."""
+        stages = {}
+        with self._lock:
+            records = list(self.records)
+        for record in records:
+            stage = stages.setdefault(
+                record["stage"],
+                dict(
+                    count=0,
+                    wall_seconds=0.0,
+                    cpu_seconds=0.0,
+                    child_cpu_seconds=0.0,
+                    child_peak_rss_kb=0,
+                    bytes_read=0,
+                    bytes_written=0,
+                    child_bytes_read=0,
+                    child_bytes_written=0,
+                ),
+            )
+            stage["count"] += 1
+            for field, value in record.items():
+                if field == "child_peak_rss_kb":
+                    stage[field] = max(stage[field], value)
+                elif field in stage and field != "count":
+                    stage[field] += value
+        return stages
+
+    def log_summary(self):
+        for stage, totals in self.summary().items():
+            logging.info(
+                f"Stage {stage}: {totals['count']} runs, "
+                f"{totals['wall_seconds']:.2f}s wall, "
+                f"{totals['cpu_seconds'] + totals['child_cpu_seconds']:.2f}s "
+                f"cpu, peak child rss {totals['child_peak_rss_kb']} KiB"
+            )
+
+    def write(self, path):
+        """Write the summary and every measurement to a JSON file."""
+        with self._lock:
+            records = list(self.records)
+        with open(path, "w") as f:
+            json.dump(
+                dict(stages=self.summary(), records=records), f, indent=1
+            )
+        return path
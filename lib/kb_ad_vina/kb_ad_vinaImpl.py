@@ -43,6 +43,10 @@ class kb_ad_vina:
         self.callback_url = os.environ['SDK_CALLBACK_URL']
         self.shared_folder = config['scratch']
         self.ws_url = config['workspace-url']
+        # The caches are disabled unless cache-dir is deployed.
+        self.cache_dir = config.get('cache-dir') or None
+        self.cache_max_bytes = int(
+            config.get('cache-max-bytes') or 10 * 2**30)
         logging.basicConfig(format='%(created)s %(levelname)s: %(message)s',
                             level=logging.INFO)
         #END_CONSTRUCTOR
@@ -61,6 +65,8 @@ class kb_ad_vina:
         #BEGIN run_kb_ad_vina
 
         config = dict(
+            cache_dir=self.cache_dir,
+            cache_max_bytes=self.cache_max_bytes,
             callback_url=self.callback_url,
             shared_folder=self.shared_folder,
             ws_url=self.ws_url,
@@ -0,0 +1,232 @@
+"""
+A staged producer/consumer pipeline. Each stage runs a function on its own
+pool of threads and the stages are connected by bounded queues, so every
+item moves through the stages on its own instead of waiting for the rest of
+its batch.
+"""
+import itertools
+import logging
+import math
+import queue
+import threading
+import time
+
+# Marks the end of the items on a queue.
+_DONE = object()
+
+
+class Stage:
+    """
+    A step of a Pipeline.
+    param: name - a name for logs and statistics
+    param: function - called with each item, returns the item for the next
+        stage, or a list of items if fan_out is set
+    param: workers - the number of threads running function
+    param: maxsize - the capacity of the queue feeding this stage
+    param: fan_out - whether function returns a list of items
+    param: batch_size - if more than 1, function is called with a list of
+        up to batch_size of the items waiting on the queue, without waiting
+        for more to arrive, and returns a list with the output of each
+    param: priority - if given, a function of an item returning a number;
+        the items waiting on the queue are taken lowest first instead of in
+        the order they arrived
+    """
+
+    def __init__(
+        self,
+        name,
+        function,
+        workers=1,
+        maxsize=0,
+        fan_out=False,
+        batch_size=1,
+        priority=None,
+    ):
+        self.name = name
+        self.function = function
+        self.workers = max(1, workers)
+        self.batch_size = max(1, batch_size)
+        self.maxsize = maxsize or max(2 * self.workers, self.batch_size)
+        self.fan_out = fan_out
+        self.priority = priority
+        if priority is None:
+            self.queue = queue.Queue(self.maxsize)
+        else:
+            self.queue = queue.PriorityQueue(self.maxsize)
+        # Breaks ties between items of the same priority by arrival.
+        self._arrivals = itertools.count()
+        self.processed = 0
+        self.busy = 0.0
+        self.max_depth = 0
+        self.depth_samples = 0
+        self.depth_total = 0
+        self.started = None
+        self.finished = None
+        self._lock = threading.Lock()
+
+    def _entry(self, item, priority):
+        if self.priority is None:
+            return item
+        return (priority, next(self._arrivals), item)
+
+    def _item(self, entry):
+        return entry if self.priority is None else entry[2]
+
+    def put(self, item):
+        priority = None if self.priority is None else self.priority(item[1])
+        self.queue.put(self._entry(item, priority))
+        depth = self.queue.qsize()
+        with self._lock:
+            self.max_depth = max(self.max_depth, depth)
+            self.depth_samples += 1
+            self.depth_total += depth
+
+    def record(self, started, finished, count=1):
+        with self._lock:
+            if self.started is None:
+                self.started = started
+            self.finished = finished
+            self.processed += count
+            self.busy += finished - started
+
+    def close(self):
+        """Mark the end of the items for each worker, after the items."""
+        for _ in range(self.workers):
+            self.queue.put(self._entry(_DONE, math.inf))
+
+    def get_batch(self):
+        """
+        Return the next batch of items from the queue, at most batch_size
+        of them, and whether the end of the items was reached.
+        """
+        item = self._item(self.queue.get())
+        if item is _DONE:
+            return [], True
+        batch = [item]
+        while len(batch) < self.batch_size:
+            try:
+                item = self._item(self.queue.get_nowait())
+            except queue.Empty:
+                break
+            if item is _DONE:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def stats(self):
+        """Return the queue depth and throughput of this stage."""
+        elapsed = (self.finished or 0) - (self.started or 0)
+        return dict(
+            name=self.name,
+            workers=self.workers,
+            processed=self.processed,
+            busy_seconds=round(self.busy, 3),
+            elapsed_seconds=round(elapsed, 3),
+            throughput_per_minute=(
+                round(60 * self.processed / elapsed, 2) if elapsed > 0 else None
+            ),
+            max_queue_depth=self.max_depth,
+            mean_queue_depth=(
+                round(self.depth_total / self.depth_samples, 2)
+                if self.depth_samples
+                else 0
+            ),
+        )
+
+
+class Pipeline:
+    """
+    Run items through a list of stages. Results are returned in the order of
+    the input items; the items a fan out stage returns for one item keep
+    their relative order.
+    """
+
+    def __init__(self, stages):
+        self.stages = stages
+        self.results = []
+        self.errors = []
+        self._lock = threading.Lock()
+
+    def _work(self, index, remaining):
+        stage = self.stages[index]
+        following = None
+        if index + 1 < len(self.stages):
+            following = self.stages[index + 1]
+        done = False
+        while not done:
+            batch, done = stage.get_batch()
+            if not batch or self.errors:
+                # Drain the queue without doing more work after a failure.
+                continue
+            keys = [key for key, _ in batch]
+            started = time.monotonic()
+            try:
+                if stage.batch_size > 1:
+                    output = stage.function([value for _, value in batch])
+                else:
+                    output = [stage.function(batch[0][1])]
+            except Exception as error:
+                logging.exception(f"Pipeline stage {stage.name} failed.")
+                with self._lock:
+                    self.errors.append(error)
+                continue
+            stage.record(started, time.monotonic(), len(batch))
+            outputs = []
+            for key, out in zip(keys, output):
+                if stage.fan_out:
+                    outputs += [(key + (i,), o) for i, o in enumerate(out)]
+                else:
+                    outputs.append((key, out))
+            for out in outputs:
+                if following is None:
+                    with self._lock:
+                        self.results.append(out)
+                else:
+                    following.put(out)
+        # The last worker of a stage to finish closes the next stage.
+        with self._lock:
+            remaining[index] -= 1
+            closing = remaining[index] == 0
+        if closing and following is not None:
+            following.close()
+
+    def run(self, items):
+        """
+        Feed items through the stages and return the outputs of the last
+        stage. The first exception raised by a stage is re-raised.
+        """
+        remaining = [stage.workers for stage in self.stages]
+        threads = [
+            threading.Thread(
+                target=self._work,
+                args=(index, remaining),
+                name=f"{stage.name}-{worker}",
+                daemon=True,
+            )
+            for index, stage in enumerate(self.stages)
+            for worker in range(stage.workers)
+        ]
+        for thread in threads:
+            thread.start()
+        first = self.stages[0]
+        for index, item in enumerate(items):
+            first.put(((index,), item))
+        first.close()
+        for thread in threads:
+            thread.join()
+        if self.errors:
+            raise self.errors[0]
+        return [value for _, value in sorted(self.results, key=lambda r: r[0])]
+
+    def stats(self):
+        """Return the statistics of each stage."""
+        return [stage.stats() for stage in self.stages]
+
+    def log_stats(self):
+        for stats in self.stats():
+            logging.info(
+                "Pipeline stage {name}: {processed} items, "
+                "{throughput_per_minute} per minute, "
+                "max queue depth {max_queue_depth}, "
+                "mean queue depth {mean_queue_depth}".format(**stats)
+            )
@@ -0,0 +1,151 @@
+"""
+Geometric detection of candidate binding pockets on a receptor.
+
+The receptor is placed on a grid, grid points near an atom are marked as
+protein and each remaining point is scored by its buriedness: the number of
+seven directions (the three axes and the four cube diagonals) along which it
+is enclosed by protein on both sides, as in LIGSITE. Connected clusters of
+buried points are the candidate pockets.
+"""
+import math
+
+import numpy as np
+
+DIRECTIONS = (
+    (1, 0, 0),
+    (0, 1, 0),
+    (0, 0, 1),
+    (1, 1, 1),
+    (1, 1, -1),
+    (1, -1, 1),
+    (-1, 1, 1),
+)
+
+NEIGHBORS = [
+    (i, j, k)
+    for i in (-1, 0, 1)
+    for j in (-1, 0, 1)
+    for k in (-1, 0, 1)
+    if (i, j, k) != (0, 0, 0)
+]
+
+
+def shift(grid, offset):
+    """
+    Return grid shifted by offset grid points, so that
+    result[p] == grid[p - offset], filling with False.
+    """
+    result = np.zeros_like(grid)
+    target = []
+    source = []
+    for delta, size in zip(offset, grid.shape):
+        if abs(delta) >= size:
+            return result
+        if delta >= 0:
+            target.append(slice(delta, size))
+            source.append(slice(0, size - delta))
+        else:
+            target.append(slice(0, size + delta))
+            source.append(slice(-delta, size))
+    result[tuple(target)] = grid[tuple(source)]
+    return result
+
+
+def reach(occupied, direction):
+    """
+    Return a mask of the grid points which have an occupied point at or
+    behind them along direction, by doubling the distance covered at each
+    step.
+    """
+    reached = occupied.copy()
+    distance = 1
+    while distance < max(occupied.shape):
+        reached |= shift(reached, [distance * d for d in direction])
+        distance *= 2
+    return reached
+
+
+def occupancy_grid(coordinates, origin, shape, spacing, probe_radius):
+    """Mark the grid points within probe_radius of any atom."""
+    occupied = np.zeros(shape, dtype=bool)
+    indices = np.rint((coordinates - origin) / spacing).astype(int)
+    steps = int(math.ceil(probe_radius / spacing))
+    span = np.arange(-steps, steps + 1)
+    offsets = np.stack(np.meshgrid(span, span, span), -1).reshape(-1, 3)
+    offsets = offsets[
+        (offsets * spacing) ** 2 @ np.ones(3) <= probe_radius**2
+    ]
+    for offset in offsets:
+        points = indices + offset
+        inside = np.all((points >= 0) & (points < shape), axis=1)
+        points = points[inside]
+        occupied[points[:, 0], points[:, 1], points[:, 2]] = True
+    return occupied
+
+
+def buriedness(occupied):
+    """
+    Return, for each grid point, the number of directions along which it is
+    enclosed by occupied points on both sides.
+    """
+    counts = np.zeros(occupied.shape, dtype=np.int8)
+    for direction in DIRECTIONS:
+        opposite = [-d for d in direction]
+        counts += reach(occupied, direction) & reach(occupied, opposite)
+    return counts
+
+
+def clusters(mask):
+    """
+    Return the connected clusters of the points of a mask, each as an array
+    of grid indices, using 26-connectivity.
+    """
+    remaining = set(map(tuple, np.argwhere(mask)))
+    found = []
+    while remaining:
+        seed = remaining.pop()
+        cluster = [seed]
+        stack = [seed]
+        while stack:
+            i, j, k = stack.pop()
+            for di, dj, dk in NEIGHBORS:
+                neighbor = (i + di, j + dj, k + dk)
+                if neighbor in remaining:
+                    remaining.remove(neighbor)
+                    cluster.append(neighbor)
+                    stack.append(neighbor)
+        found.append(np.array(cluster))
+    return found
+
+
+def detect_pockets(
+    coordinates,
+    spacing=1.0,
+    probe_radius=3.0,
+    min_buriedness=5,
+    min_volume=30.0,
+):
+    """
+    Return the candidate pockets among the atom coordinates of a receptor,
+    best first, as a list of dictionaries with the coordinates of the grid
+    points of the pocket, its volume in cubic Angstrom and its score, the
+    sum of the buriedness of its points.
+    """
+    origin = coordinates.min(axis=0)
+    shape = tuple(
+        np.ceil((coordinates.max(axis=0) - origin) / spacing).astype(int) + 1
+    )
+    occupied = occupancy_grid(coordinates, origin, shape, spacing, probe_radius)
+    buried = buriedness(occupied)
+    candidates = ~occupied & (buried >= min_buriedness)
+    min_points = math.ceil(min_volume / spacing**3)
+    pockets = [
+        dict(
+            coordinates=origin + cluster * spacing,
+            volume=len(cluster) * spacing**3,
+            score=int(buried[tuple(cluster.T)].sum()),
+        )
+        for cluster in clusters(candidates)
+        if len(cluster) >= min_points
+    ]
+    return sorted(pockets, key=lambda pocket: pocket["score"], reverse=True)
@@ -0,0 +1,185 @@
+"""
+A work queue on a shared file system, through which the dockings of a job
+are distributed to worker processes on any host that mounts it.
+
+Each task is a JSON file which a worker claims by renaming it from pending/
+to claimed/, so that exactly one worker gets it, and whose result the
+worker writes to done/. Workers refresh the modification time of their
+claims while they work, and claims which go stale because their worker
+died are put back in pending/.
+"""
+import json
+import logging
+import os
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+# Seconds after which a claim that has not been refreshed is stale.
+LEASE_SECONDS = 60
+
+
+class SpoolError(Exception):
+    pass
+
+
+def write_json(path, data):
+    """Write data to a JSON file which readers never see partially written."""
+    tmp = os.path.join(
+        os.path.dirname(os.path.dirname(path)), "tmp", uuid.uuid4().hex
+    )
+    with open(tmp, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+class Spool:
+    """A directory of pending, claimed and done tasks."""
+
+    def __init__(self, path, lease=LEASE_SECONDS):
+        self.path = path
+        self.lease = lease
+        self._requeued = time.monotonic()
+        self._lock = threading.Lock()
+        for state in ("pending", "claimed", "done", "tmp"):
+            os.makedirs(os.path.join(path, state), exist_ok=True)
+
+    def _path(self, state, task_id):
+        return os.path.join(self.path, state, f"{task_id}.json")
+
+    def submit(self, task):
+        """
+        Add a task, a JSON serializable dictionary, and return its id.
+        Tasks are claimed in the order they were submitted.
+        """
+        task_id = f"{time.time_ns():020d}-{uuid.uuid4().hex}"
+        write_json(self._path("pending", task_id), task)
+        return task_id
+
+    def claim(self):
+        """
+        Claim the oldest pending task and return a tuple (task_id, task), or
+        None if there is no pending task.
+        """
+        for name in sorted(os.listdir(os.path.join(self.path, "pending"))):
+            task_id = name[: -len(".json")]
+            claimed = self._path("claimed", task_id)
+            try:
+                os.rename(self._path("pending", task_id), claimed)
+                # The claim is as old as its last refresh.
+                os.utime(claimed)
+                with open(claimed) as f:
+                    return task_id, json.load(f)
+            except FileNotFoundError:
+                # Another worker claimed it first.
+                continue
+        return None
+
+    def refresh(self, task_id):
+        """Keep the claim of a task from going stale."""
+        try:
+            os.utime(self._path("claimed", task_id))
+        except FileNotFoundError:
+            pass
+
+    def complete(self, task_id, result):
+        """
+        Store the result of a claimed task, a JSON serializable dictionary.
+        """
+        write_json(self._path("done", task_id), result)
+        try:
+            os.remove(self._path("claimed", task_id))
+        except FileNotFoundError:
+            pass
+
+    def requeue_stale(self):
+        """Put the claimed tasks whose claims went stale back in pending."""
+        now = time.time()
+        for name in os.listdir(os.path.join(self.path, "claimed")):
+            task_id = name[: -len(".json")]
+            claimed = self._path("claimed", task_id)
+            try:
+                if now - os.stat(claimed).st_mtime > self.lease:
+                    logging.warning(f"Requeueing stale task {task_id}")
+                    os.rename(claimed, self._path("pending", task_id))
+            except FileNotFoundError:
+                continue
+
+    def wait(self, task_id, poll=0.5, timeout=None, alive=None):
+        """
+        Wait for a task to be done, remove it from the spool and return its
+        result. Stale claims are requeued while waiting.
+        Raises SpoolError, withdrawing the task, if it is not done within
+        timeout seconds, or if it is pending while alive, a function which
+        returns whether any worker is still running, returns False.
+        """
+        done = self._path("done", task_id)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            try:
+                with open(done) as f:
+                    result = json.load(f)
+            except FileNotFoundError:
+                pass
+            else:
+                os.remove(done)
+                return result
+            with self._lock:
+                requeue = time.monotonic() - self._requeued > self.lease
+                if requeue:
+                    self._requeued = time.monotonic()
+            if requeue:
+                self.requeue_stale()
+            if deadline is not None and time.monotonic() > deadline:
+                self.withdraw(task_id)
+                raise SpoolError(
+                    f"Task {task_id} was not done within {timeout} seconds."
+                )
+            pending = os.path.exists(self._path("pending", task_id))
+            if pending and alive is not None and not alive():
+                # A worker may have finished the task before exiting.
+                if not os.path.exists(done):
+                    self.withdraw(task_id)
+                    raise SpoolError(
+                        f"No worker is left to do task {task_id}."
+                    )
+                continue
+            time.sleep(poll)
+
+    def withdraw(self, task_id):
+        """Remove a task which no worker has claimed yet."""
+        try:
+            os.remove(self._path("pending", task_id))
+        except FileNotFoundError:
+            pass
+
+    def start(self):
+        """Let workers run, undoing an earlier stop."""
+        try:
+            os.remove(os.path.join(self.path, "stop"))
+        except FileNotFoundError:
+            pass
+
+    def stop(self):
+        """Ask the workers to exit once the pending tasks are done."""
+        with open(os.path.join(self.path, "stop"), "w"):
+            pass
+
+    def stopped(self):
+        return os.path.exists(os.path.join(self.path, "stop"))
+
+
+def start_workers(spool_path, count, idle_timeout=None):
+    """
+    Start count worker processes on this host and return their Popen
+    objects.
+    """
+    command = [sys.executable, "-m", "kb_ad_vina.worker", spool_path]
+    if idle_timeout:
+        command += ["--idle-timeout", str(idle_timeout)]
+    # The workers import this package from the same paths.
+    pythonpath = os.pathsep.join(path for path in sys.path if path)
+    env = dict(os.environ, PYTHONPATH=pythonpath)
+    return [subprocess.Popen(command, env=env) for _ in range(count)]
@@ -2,20 +2,108 @@
 This ADVinaApp takes a receptor ref and a list of ligand refs and performs
 docking using AutoDock Vina for each (receptor, ligand) pair.
 """
+import json
 import logging
+import math
 import os
 import re
 import subprocess
 import textwrap
+import threading
+import time
 import uuid
 
-from shutil import copyfile, make_archive
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from shutil import copyfile, make_archive, which
+
+import numpy as np
+
+try:
+    from openbabel import openbabel
+except ImportError:
+    openbabel = None
 
 # This is the SFA base package which provides the Core app class.
 from base import Core
 
+from . import embedded
+from .cache import DiskCache, PackCache, hash_key
+from .checkpoint import CheckpointManifest
+from .costmodel import CostModel
+from .instrumentation import (
+    Instrumentation,
+    add_child_usage,
+    communicate,
+    measurement,
+    wait_child,
+)
+from .pipeline import Pipeline, Stage
+from .pockets import detect_pockets
+from .spool import Spool, SpoolError, start_workers
+
 upa_filename_pattern = r"_w([0-9]+)o([0-9]+)v([0-9]+)_"
 
+# The citation of vina for the engines running the vina Python package, as
+# printed by the vina command of the same release.
+VINA_PACKAGE_CITATION = """\
+#################################################################
+# If you used AutoDock Vina in your work, please cite:          #
+#                                                               #
+# J. Eberhardt, D. Santos-Martins, A. F. Tillack, and S. Forli  #
+# AutoDock Vina 1.2.0: New Docking Methods, Expanded Force      #
+# Field, and Python Bindings, J. Chem. Inf. Model. (2021)       #
+# DOI 10.1021/acs.jcim.1c00203                                  #
+#                                                               #
+# O. Trott, A. J. Olson,                                        #
+# AutoDock Vina: improving the speed and accuracy of docking    #
+# with a new scoring function, efficient optimization and       #
+# multithreading, J. Comp. Chem. (2010)                         #
+# DOI 10.1002/jcc.21334                                         #
+#################################################################
+"""
+
+# The vina search parameters and their defaults. vina draws a random seed
+# for seed 0, so the default seed is fixed instead to make dockings
+# reproducible and safe to cache; a seed of 0 is taken as the default.
+SEARCH_PARAMETERS = dict(
+    center_x=0.0,
+    center_y=0.0,
+    center_z=0.0,
+    size_x=30.0,
+    size_y=30.0,
+    size_z=30.0,
+    seed=42,
+    exhaustiveness=8,
+    num_modes=9,
+    energy_range=3.0,
+)
+
+# The docking modes with their vina command arguments: a global search,
+# a local minimization of the input pose and scoring the input pose.
+DOCKING_MODES = dict(
+    dock="",
+    local_only="--local_only",
+    score_only="--score_only",
+)
+
+# The version of the receptor preparation in receptor_as_pdbqt. Bump it when
+# the prepared PDBQT changes so that cached receptors are prepared again.
+RECEPTOR_PREPARATION_VERSION = 2
+
+# The options of obabel when converting a ligand to PDBQT.
+LIGAND_OBABEL_OPTIONS = "-r"
+
+_inchi_lock = threading.Lock()
+
+
+class VinaError(Exception):
+    """Raised when vina fails to dock a ligand."""
+
+
+class ConversionError(Exception):
+    """Raised when Open Babel fails to convert a molecule."""
+
 
 def encode_upa_filename(upa):
     """Encode a Unique Permanent Address (upa) into a string suitable for a
@@ -31,81 +119,895 @@ def decode_upa_filename(filename):
     return "/".join(match_first)
 
 
-def get_affinity_from_vina_log(log):
-    """Return the highest affinity value from a vina log file."""
-    lines = log.split("\n")
-    return float(
-        [
-            [match for match in re.findall(r"([0-9.-]+)", line)][1]
-            for line in lines[26:27]
-        ][0]
+# A row of the table of binding modes in a vina log.
+vina_mode_pattern = re.compile(
+    r"^\s*([0-9]+)\s+([0-9.eE+-]+)\s+([0-9.eE+-]+)\s+([0-9.eE+-]+)\s*$",
+    re.MULTILINE,
+)
+
+
+def parse_vina_log(log):
+    """
+    Return the binding modes in the contents of a vina log as a list of
+    dictionaries with the keys mode, affinity, rmsd_lb and rmsd_ub, best
+    mode first.
+    """
+    # The table of modes follows a line of dashes and plus signs.
+    table = log[log.find("-----+") :]
+    return [
+        dict(
+            mode=int(mode),
+            affinity=float(affinity),
+            rmsd_lb=float(rmsd_lb),
+            rmsd_ub=float(rmsd_ub),
+        )
+        for mode, affinity, rmsd_lb, rmsd_ub in vina_mode_pattern.findall(
+            table
+        )
+    ]
+
+
+# The affinity of a pose scored or minimized without a search, reported
+# as "Affinity:" before vina 1.2 and "Estimated Free Energy of Binding"
+# since.
+vina_score_pattern = re.compile(
+    r"^(?:Affinity|Estimated Free Energy of Binding)\s*:\s*([0-9.eE+-]+)",
+    re.MULTILINE,
+)
+
+
+def parse_vina_score(log):
+    """
+    Return the affinity in the contents of the vina log of a score_only or
+    local_only run as a list of one binding mode like parse_vina_log, or
+    an empty list if there is none.
+    """
+    match = vina_score_pattern.search(log)
+    if match is None:
+        return []
+    return [
+        dict(mode=1, affinity=float(match[1]), rmsd_lb=0.0, rmsd_ub=0.0)
+    ]
+
+
+def parse_vina_output(log, mode="dock"):
+    """
+    Return the binding modes in the contents of the vina log of a run in
+    one of the DOCKING_MODES, like parse_vina_log.
+    """
+    if mode == "dock":
+        return parse_vina_log(log)
+    return parse_vina_score(log)
+
+
+def vina_log(modes, mode="dock", seed=None):
+    """
+    Return a vina log for a list of modes as returned by parse_vina_log,
+    with the table of binding modes of a docking or the affinity of a pose
+    scored or minimized without a search, after the seed of the search
+    like the log of the vina command if it is given.
+    """
+    lines = [] if seed is None else [f"Using random seed: {seed}"]
+    if mode != "dock":
+        lines.extend(
+            f"Affinity: {mode['affinity']:.3f} (kcal/mol)"
+            for mode in modes[:1]
+        )
+        return "".join(line + "\n" for line in lines)
+    lines += [
+        "mode |   affinity | dist from best mode",
+        "     | (kcal/mol) | rmsd l.b.| rmsd u.b.",
+        "-----+------------+----------+----------",
+    ]
+    for mode in modes:
+        lines.append(
+            f"{mode['mode']:4d} {mode['affinity']:12.3f} "
+            f"{mode['rmsd_lb']:10.3f} {mode['rmsd_ub']:10.3f}"
+        )
+    return "\n".join(lines) + "\n"
+
+
+def get_affinity_from_vina_log(log, mode="dock"):
+    """
+    Return the highest affinity value from a vina log file of a run in one
+    of the DOCKING_MODES.
+    """
+    modes = parse_vina_output(log, mode)
+    if not modes:
+        raise ValueError("The vina log does not contain any binding modes.")
+    return modes[0]["affinity"]
+
+
+def parse_pdbqt_poses(pdbqt):
+    """
+    Parse the contents of a vina output PDBQT file. Returns a tuple of an
+    array of the atom coordinates of each pose with the shape
+    (poses, atoms, 3) and an array of the affinity of each pose.
+    """
+    coordinates = []
+    affinities = []
+    for line in pdbqt.splitlines():
+        if line.startswith(("ATOM", "HETATM")):
+            coordinates.append((line[30:38], line[38:46], line[46:54]))
+        elif line.startswith("REMARK VINA RESULT:"):
+            affinities.append(line.split()[3])
+    affinities = np.array(affinities, dtype=np.float32)
+    poses = max(len(affinities), 1)
+    return (
+        np.array(coordinates, dtype=np.float32).reshape(poses, -1, 3),
+        affinities,
     )
 
 
-def receptor_as_pdbqt(receptor):
+def search_parameters(params):
     """
-    This function expects receptor to be a path to a receptor in pdb format
-    whose file extension is .pdb.
+    Return the vina search parameters from params with defaults filled in
+    and values converted to the types vina expects.
+    """
+    return {
+        name: type(default)(params.get(name) or default)
+        for name, default in SEARCH_PARAMETERS.items()
+    }
+
+
+def scoring_function(params):
+    """Return the name of the vina scoring function in params."""
+    return params.get("scoring") or "vina"
+
+
+def docking_mode(params):
+    """Return the mode of params, one of the DOCKING_MODES."""
+    mode = params.get("mode") or "dock"
+    if mode not in DOCKING_MODES:
+        raise ValueError(f"Unknown docking mode {mode}.")
+    return mode
+
+
+def docking_options(params):
+    """
+    Return the docking engine of params with the version of its software,
+    and the scoring function and the mode of params which differ from the
+    defaults. These enter the keys of dockings, so that results of
+    different engines or versions are kept apart.
+    """
+    engine = DOCKING_ENGINES[params.get("engine") or "cli"]
+    options = [f"{engine.name} {engine.version()}"]
+    if scoring_function(params) != "vina":
+        options.append(scoring_function(params))
+    if docking_mode(params) != "dock":
+        options.append(docking_mode(params))
+    return options
+
+
+def search_threads(params):
+    """
+    Return the number of threads vina can use for a docking with params:
+    its exhaustiveness, or one without a search.
+    """
+    if docking_mode(params) != "dock":
+        return 1
+    return params.get("exhaustiveness", 8)
+
+
+def docking_cache_key(receptor, ligand, params, maps=None):
+    """
+    Return the result cache key of a docking: a hash of the receptor and
+    ligand PDBQT contents, the normalized search parameters, the engine
+    and its version, the scoring function and mode and whether precomputed
+    grid maps were used, since their box is rounded to an even number of
+    voxels.
+    """
+    with open(receptor, "rb") as f:
+        receptor_data = f.read()
+    with open(ligand, "rb") as f:
+        ligand_data = f.read()
+    search = json.dumps(search_parameters(params), sort_keys=True)
+    for option in docking_options(params):
+        search += f" {option}"
+    if maps:
+        search += " maps"
+    return hash_key(receptor_data, ligand_data, search)
+
+
+def screening_parameters(params):
+    """
+    Return the parameters of the cheap pre-docking stage of a two-stage
+    screen, or None if params do not ask for a screen. A screen is requested
+    with screen_top_k or screen_top_percent.
+    """
+    if not (params.get("screen_top_k") or params.get("screen_top_percent")):
+        return None
+    return dict(
+        params,
+        exhaustiveness=params.get("prescreen_exhaustiveness") or 1,
+        num_modes=params.get("prescreen_num_modes") or 1,
+    )
+
+
+def receptor_references(params):
+    """
+    Return the list of receptor references/upas to dock to, from the
+    receptor_refs list or the single receptor_ref in params.
+    """
+    receptor_refs = params.get("receptor_refs") or params.get("receptor_ref")
+    if isinstance(receptor_refs, str):
+        receptor_refs = [receptor_refs]
+    if not receptor_refs:
+        raise ValueError("No receptor_refs were given.")
+    return list(dict.fromkeys(receptor_refs))
+
+
+def affinity_matrix(logdatas):
+    """
+    Return the best affinity of each ligand for each receptor from a list
+    of the logdata of process_vina_output, as a tuple of the sorted
+    receptor references and a list of rows, one per ligand, each with the
+    ligand name, compound_set, ligand_ref and a list of affinities in the
+    order of the receptors, None for a receptor it was not docked to.
+    """
+    receptor_refs = sorted({logdata["receptor_ref"] for logdata in logdatas})
+    rows = {}
+    for logdata in logdatas:
+        row = rows.setdefault(
+            logdata["ligand_pdbqt_input"],
+            dict(
+                name=logdata["name"],
+                compound_set=logdata["compound_set"],
+                ligand_ref=logdata["ligand_ref"],
+                affinities={},
+            ),
+        )
+        affinity = logdata["affinity"]
+        best = row["affinities"].get(logdata["receptor_ref"])
+        if affinity is not None and (best is None or affinity < best):
+            row["affinities"][logdata["receptor_ref"]] = affinity
+    return receptor_refs, [
+        dict(row, affinities=[row["affinities"].get(r) for r in receptor_refs])
+        for row in rows.values()
+    ]
+
+
+def select_top_ligands(affinities, top_k=None, top_percent=None):
+    """
+    Return the indices of the best (lowest) affinities, at most top_k of
+    them and at most top_percent percent of them. Missing affinities are
+    never selected.
+    """
+    ranked = sorted(
+        (affinity, index)
+        for index, affinity in enumerate(affinities)
+        if affinity is not None
+    )
+    count = len(ranked)
+    if top_k:
+        count = min(count, int(top_k))
+    if top_percent:
+        percent = math.ceil(len(affinities) * float(top_percent) / 100)
+        count = min(count, max(1, percent))
+    return sorted(index for _, index in ranked[:count])
+
+
+def checkpoint_key(receptor, ligand, working_directory, params):
     """
-    obabel_cmd_receptor = (
-        f"obabel -i pdb {receptor} -o pdbqt -O {receptor}.obabel.pdbqt"
+    Return the key of a docking in a CheckpointManifest. Filenames are
+    stable across runs because they encode the immutable upas of the
+    inputs.
+    """
+    key = [
+        os.path.split(receptor)[1],
+        os.path.split(ligand)[1],
+        os.path.split(working_directory)[1],
+        search_parameters(params),
+        *docking_options(params),
+    ]
+    return json.dumps(key, sort_keys=True)
+
+
+def read_pdb_atoms(pdb):
+    """
+    Read the ATOM and HETATM records of a PDB file into a dictionary of
+    NumPy arrays with one entry per atom: record, name, resname, chain,
+    residue and coordinates, the last with the shape (atoms, 3).
+    """
+    fields = dict(record=[], name=[], resname=[], chain=[], residue=[])
+    coordinates = []
+    with open(pdb) as f:
+        for line in f:
+            if not line.startswith(("ATOM  ", "HETATM")):
+                continue
+            fields["record"].append(line[0:6].strip())
+            fields["name"].append(line[12:16].strip())
+            fields["resname"].append(line[17:20].strip())
+            fields["chain"].append(line[21])
+            fields["residue"].append(line[22:26])
+            coordinates.append((line[30:38], line[38:46], line[46:54]))
+    atoms = {field: np.array(values) for field, values in fields.items()}
+    atoms["residue"] = atoms["residue"].astype(int)
+    atoms["coordinates"] = np.array(coordinates, dtype=float).reshape(-1, 3)
+    return atoms
+
+
+def residue_selection_mask(atoms, selection):
+    """
+    Return a mask of the atoms in a residue selection: a comma separated
+    list of residues or ranges of residues, each optionally prefixed by a
+    chain, for example "A:45-60,A:72,B:12".
+    """
+    mask = np.zeros(len(atoms["residue"]), dtype=bool)
+    for item in selection.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        chain, _, span = item.rpartition(":")
+        start, _, end = span.partition("-")
+        selected = (atoms["residue"] >= int(start)) & (
+            atoms["residue"] <= int(end or start)
+        )
+        if chain:
+            selected &= atoms["chain"] == chain
+        mask |= selected
+    return mask
+
+
+def search_box(coordinates, margin=4.0):
+    """
+    Return the vina search box parameters of the smallest box containing
+    coordinates padded by margin Angstrom on each side.
+    """
+    if not len(coordinates):
+        raise ValueError("No atoms were selected for the search box.")
+    low = coordinates.min(axis=0)
+    high = coordinates.max(axis=0)
+    center = (low + high) / 2
+    size = high - low + 2 * margin
+    return dict(
+        center_x=round(float(center[0]), 3),
+        center_y=round(float(center[1]), 3),
+        center_z=round(float(center[2]), 3),
+        size_x=round(float(size[0]), 3),
+        size_y=round(float(size[1]), 3),
+        size_z=round(float(size[2]), 3),
     )
+
+
+def search_box_mask(atoms, params):
+    """
+    Return a mask of the receptor atoms that define the search box
+    requested by the box_mode parameter: "residues" selects the atoms of
+    the box_residues selection, "reference_ligand" selects the HETATM
+    records of the residue named box_reference_ligand, for example a
+    co-crystallized ligand.
+    """
+    box_mode = params.get("box_mode")
+    if box_mode == "residues":
+        return residue_selection_mask(atoms, params.get("box_residues", ""))
+    if box_mode == "reference_ligand":
+        resname = params.get("box_reference_ligand", "").strip().upper()
+        return (atoms["record"] == "HETATM") & (atoms["resname"] == resname)
+    raise ValueError(f"Unknown box_mode {box_mode}")
+
+
+def available_cpus():
+    """Return the number of cores this process is allowed to run on."""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def allocate_cpus(num_tasks, exhaustiveness=8, total_cpus=None):
+    """
+    Split the available cores between concurrent vina processes and the
+    threads of each process. Vina does not use more threads than its
+    exhaustiveness, and independent processes scale better than threads, so
+    cores go to concurrent jobs first.
+    Returns a tuple (workers, cpus_per_task).
+    """
+    total_cpus = max(1, int(total_cpus or available_cpus()))
+    num_tasks = max(1, num_tasks)
+    cpus_per_task = max(1, min(int(exhaustiveness), total_cpus // num_tasks))
+    workers = max(1, min(num_tasks, total_cpus // cpus_per_task))
+    return workers, cpus_per_task
+
+
+def receptor_pdbqt_lines(receptor):
+    """
+    Convert the receptor PDB file to PDBQT and yield the lines of the
+    result. The openbabel Python bindings are used if they are installed,
+    otherwise the output of obabel is streamed without a temporary file.
+    A ConversionError is raised if the receptor can not be read or obabel
+    fails.
+    """
+    if openbabel is not None:
+        conversion = openbabel.OBConversion()
+        conversion.SetInAndOutFormats("pdb", "pdbqt")
+        molecule = openbabel.OBMol()
+        if not conversion.ReadFile(molecule, receptor):
+            raise ConversionError(f"Open Babel could not read {receptor}.")
+        yield from conversion.WriteString(molecule).splitlines(keepends=True)
+        return
     with subprocess.Popen(
-        obabel_cmd_receptor,
-        shell=True,
+        ["obabel", "-i", "pdb", receptor, "-o", "pdbqt"],
         stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        text=True,
     ) as proc:
-        proc.communicate()
+        yield from proc.stdout
+        if wait_child(proc):
+            raise ConversionError(
+                f"obabel could not convert {receptor}: exit code "
+                f"{proc.returncode}"
+            )
+
+
+@lru_cache(maxsize=None)
+def openbabel_version():
+    """Return the version of Open Babel used to convert molecules."""
+    if openbabel is not None:
+        return openbabel.OBReleaseVersion()
+    proc = subprocess.run(["obabel", "-V"], capture_output=True, text=True)
+    return proc.stdout.strip()
+
+
+def receptor_cache_key(receptor_ref):
+    """
+    Return the receptor cache key of a receptor: its encoded upa, which
+    names an immutable object, and a hash of the versions of the
+    preparation and of Open Babel.
+    """
+    version = hash_key(str(RECEPTOR_PREPARATION_VERSION), openbabel_version())
+    return f"{encode_upa_filename(receptor_ref)}{version[:16]}"
 
+
+def receptor_as_pdbqt(receptor):
+    """
+    This function expects receptor to be a path to a receptor in pdb format
+    whose file extension is .pdb. Only the ATOM and TER records of the
+    converted receptor are kept. A ConversionError is raised, and no file
+    is left, if the conversion fails or has no atoms.
+    """
     out_filename = f"{receptor}qt"
+    atoms = 0
+    try:
+        with open(out_filename, "w") as out:
+            for line in receptor_pdbqt_lines(receptor):
+                if line.startswith(("ATOM", "TER")):
+                    atoms += line.startswith("ATOM")
+                    out.write(line)
+        if not atoms:
+            raise ConversionError(f"No atoms were converted from {receptor}.")
+    except ConversionError:
+        os.remove(out_filename)
+        raise
+    return out_filename
+
+
+def iter_sdf_records(sdf):
+    """
+    Yield the text of each molecule record in an SDF file, reading one line
+    at a time.
+    """
+    record = []
+    with open(sdf) as f:
+        for line in f:
+            record.append(line)
+            if line.startswith("$$$$"):
+                yield "".join(record)
+                record = []
+    if "".join(record).strip():
+        yield "".join(record)
+
+
+def split_sdf(sdf):
+    """
+    Write each molecule of an SDF file to its own SDF file next to it and
+    yield a tuple (path, title) for each of them. The files are named after
+    the original with the index of the molecule appended, so that
+    _w1o2v3_.sdf is split into _w1o2v3_m0.sdf, _w1o2v3_m1.sdf, ...
+    """
+    stem = sdf[: -len(".sdf")] if sdf.endswith(".sdf") else sdf
+    for index, record in enumerate(iter_sdf_records(sdf)):
+        path = f"{stem}m{index}.sdf"
+        with open(path, "w") as f:
+            f.write(record)
+        title = record.split("\n", 1)[0].strip() or f"molecule {index + 1}"
+        yield path, title
+
+
+def ligand_as_pdbqt(ligand):
+    """
+    This function expects ligand to be a path to a ligand in sdf format.
+    A ConversionError is raised if Open Babel fails or writes no molecule.
+    """
+    ligand_obabel_cmd = (
+        f"obabel -i sdf {ligand} -o pdbqt -O {ligand}.pdbqt "
+        f"{LIGAND_OBABEL_OPTIONS}"
+    )
     with subprocess.Popen(
-        f"""grep -e "^\\(ATOM\\|TER\\)" {receptor}.obabel.pdbqt \\
-            >> {out_filename}
-        """,
+        ligand_obabel_cmd,
         shell=True,
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
     ) as proc:
-        proc.communicate()
-    return out_filename
+        _, stderr = communicate(proc)
+    output = f"{ligand}.pdbqt"
+    if proc.returncode or not os.path.exists(output):
+        raise ConversionError(
+            f"obabel could not convert {ligand}: "
+            f"{stderr.decode(errors='replace').strip()}"
+        )
+    if not os.path.getsize(output):
+        os.remove(output)
+        raise ConversionError(f"obabel found no molecule in {ligand}.")
+    return output
 
 
-def ligand_as_pdbqt(ligand):
+def inchikey(ligand):
     """
-    This function expects ligand to be a path to a ligand in sdf format.
+    Return the InChIKey of the molecule in an SDF file, or an empty string
+    if Open Babel can not compute one.
+    """
+    if openbabel is not None:
+        # The InChI format of Open Babel keeps state between molecules.
+        with _inchi_lock:
+            conversion = openbabel.OBConversion()
+            conversion.SetInAndOutFormats("sdf", "inchikey")
+            molecule = openbabel.OBMol()
+            if not conversion.ReadFile(molecule, ligand):
+                return ""
+            return conversion.WriteString(molecule).strip()
+    proc = subprocess.run(
+        ["obabel", "-i", "sdf", ligand, "-o", "inchikey"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        text=True,
+    )
+    return proc.stdout.strip()
+
+
+def sdf_3d_coordinates(ligand):
+    """
+    Return the atom block of the molecule in an SDF file if it has 3D
+    coordinates, or an empty string for a 2D molecule.
+    """
+    with open(ligand) as f:
+        lines = f.read().splitlines()
+    if len(lines) < 4:
+        return ""
+    atoms = lines[4 : 4 + int(lines[3][:3] or 0)]
+    if all(float(line[20:30] or 0) == 0 for line in atoms):
+        return ""
+    return "\n".join(atoms)
+
+
+def molecule_key(ligand):
+    """
+    Return a key identifying the structure of the molecule in a ligand SDF
+    file, or None if it can not be identified. The key combines the
+    InChIKey of the molecule, so that the same molecule from any compound
+    set shares a key, with any 3D input coordinates, which obabel keeps.
+    """
+    key = inchikey(ligand)
+    if not key:
+        return None
+    return hash_key(key, sdf_3d_coordinates(ligand))
+
+
+def ligand_cache_key(ligand, molecule=None):
+    """
+    Return the ligand conversion cache key of a ligand SDF file, or None if
+    its molecule can not be identified: its molecule_key, which may be
+    given as molecule if already known, and the obabel options and version.
+    """
+    molecule = molecule or molecule_key(ligand)
+    if not molecule:
+        return None
+    return hash_key(molecule, LIGAND_OBABEL_OPTIONS, openbabel_version())
+
+
+# The elements of the AutoDock atom types which are not element symbols.
+AUTODOCK_ELEMENTS = dict(A="C", HD="H", HS="H", NA="N", NS="N", OA="O", SA="S")
+
+# Standard atomic weights of the elements found in drug-like molecules.
+ATOMIC_WEIGHTS = dict(
+    H=1.008,
+    B=10.81,
+    C=12.011,
+    N=14.007,
+    O=15.999,
+    F=18.998,
+    Si=28.085,
+    P=30.974,
+    S=32.06,
+    Cl=35.45,
+    Br=79.904,
+    I=126.904,
+)
+
+# The ligand filters, each disabled by a false value.
+LIGAND_FILTERS = (
+    "filter_max_heavy_atoms",
+    "filter_max_torsions",
+    "filter_max_weight",
+    "filter_lipinski",
+    "filter_veber",
+)
+
+
+def ligand_descriptors(ligands):
     """
-    ligand_obabel_cmd = f"obabel -i sdf {ligand} -o pdbqt -O {ligand}.pdbqt -r"
+    Compute descriptors of ligand PDBQT files in one vectorized pass and
+    return a dictionary of NumPy arrays with one entry per ligand:
+    heavy_atoms, torsions (from TORSDOF), donors (polar hydrogens),
+    acceptors (nitrogen and oxygen atoms) and molecular_weight. The weight
+    is computed from the atoms of the SDF file each PDBQT was converted
+    from, since the PDBQT lacks the non-polar hydrogens, and is 0 if there
+    is no such file. errors is a list with, for each ligand, why its files
+    could not be read, or an empty string, and its descriptors are 0.
+    """
+    owners = []
+    elements = []
+    torsions = np.zeros(len(ligands), dtype=int)
+    weight_owners = []
+    weights = []
+    errors = [""] * len(ligands)
+    for index, ligand in enumerate(ligands):
+        try:
+            ligand_elements, ligand_torsions = pdbqt_elements(ligand)
+            sdf = ligand[: -len(".pdbqt")]
+            sdf_atoms = sdf_elements(sdf) if os.path.exists(sdf) else []
+        except (OSError, ValueError, IndexError) as exc:
+            errors[index] = f"could not read {ligand}: {exc}"
+            continue
+        owners += [index] * len(ligand_elements)
+        elements += ligand_elements
+        torsions[index] = ligand_torsions
+        weight_owners += [index] * len(sdf_atoms)
+        weights += [ATOMIC_WEIGHTS.get(element, 0.0) for element in sdf_atoms]
+    owners = np.array(owners, dtype=int)
+    elements = np.array(elements, dtype=str)
+    heavy = elements != "H"
+    return dict(
+        heavy_atoms=np.bincount(owners[heavy], minlength=len(ligands)),
+        torsions=torsions,
+        donors=np.bincount(
+            owners, weights=elements == "H", minlength=len(ligands)
+        ).astype(int),
+        acceptors=np.bincount(
+            owners,
+            weights=np.isin(elements, ["N", "O"]),
+            minlength=len(ligands),
+        ).astype(int),
+        molecular_weight=np.bincount(
+            np.array(weight_owners, dtype=int),
+            weights=np.array(weights, dtype=float),
+            minlength=len(ligands),
+        ),
+        errors=errors,
+    )
+
+
+def pdbqt_elements(ligand):
+    """
+    Return the elements of the atoms of a ligand PDBQT file and its number
+    of torsions, from TORSDOF.
+    """
+    elements = []
+    torsions = 0
+    with open(ligand) as f:
+        for line in f:
+            if line.startswith(("ATOM  ", "HETATM")):
+                atom_type = line[77:79].strip()
+                elements.append(AUTODOCK_ELEMENTS.get(atom_type, atom_type))
+            elif line.startswith("TORSDOF"):
+                torsions = int(line.split()[1])
+    return elements, torsions
+
+
+def sdf_elements(sdf):
+    """
+    Return the elements of the atoms of the first molecule of a V2000 or
+    V3000 SDF file. Raises ValueError if the file is malformed.
+    """
+    with open(sdf) as f:
+        lines = f.read().splitlines()
+    if len(lines) < 4:
+        raise ValueError("no counts line")
+    if "V3000" in lines[3]:
+        start = lines.index("M  V30 BEGIN ATOM")
+        end = lines.index("M  V30 END ATOM", start)
+        return [line.split()[3] for line in lines[start + 1 : end]]
+    count = int(lines[3][:3])
+    atoms = lines[4 : 4 + count]
+    if len(atoms) < count:
+        raise ValueError(f"{len(atoms)} of {count} atoms")
+    return [line[31:34].strip() for line in atoms]
+
+
+def ligand_filter_reasons(descriptors, params):
+    """
+    Apply the ligand filters in params to the ligand_descriptors and return
+    a list with, for each ligand, the reasons it fails the filters joined
+    into a string, or an empty string if it passes.
+    param: params - filter_max_heavy_atoms, filter_max_torsions and
+        filter_max_weight give limits and filter_lipinski and filter_veber
+        enable drug-likeness rules. Lipinski's rule of five allows one
+        violation of molecular weight <= 500, at most 5 hydrogen bond
+        donors and at most 10 acceptors. Veber's rule is applied as at most
+        10 rotatable bonds.
+    """
+    heavy_atoms = descriptors["heavy_atoms"]
+    torsions = descriptors["torsions"]
+    weight = descriptors["molecular_weight"]
+    reasons = [[] for _ in range(len(torsions))]
+
+    def check(failed, values, description):
+        for index in np.flatnonzero(failed):
+            reasons[index].append(description.format(values[index]))
+
+    if params.get("filter_max_heavy_atoms"):
+        limit = int(params["filter_max_heavy_atoms"])
+        check(heavy_atoms > limit, heavy_atoms, f"{{}} heavy atoms > {limit}")
+    if params.get("filter_max_torsions"):
+        limit = int(params["filter_max_torsions"])
+        check(torsions > limit, torsions, f"{{}} torsions > {limit}")
+    if params.get("filter_max_weight"):
+        limit = float(params["filter_max_weight"])
+        check(weight > limit, weight, f"molecular weight {{:.1f}} > {limit}")
+    if int(params.get("filter_lipinski") or 0):
+        violations = (
+            (weight > 500).astype(int)
+            + (descriptors["donors"] > 5)
+            + (descriptors["acceptors"] > 10)
+        )
+        check(violations > 1, violations, "{} violations of the rule of five")
+    if int(params.get("filter_veber") or 0):
+        check(torsions > 10, torsions, "{} rotatable bonds > 10")
+    return ["; ".join(reason) for reason in reasons]
+
+
+def docking_features(ligands, params, cpu=None, descriptors=None):
+    """
+    Return the features of the CostModel for docking each of a list of
+    ligand PDBQT files with params and cpu cpus, as a dictionary of arrays.
+    param: descriptors - the ligand_descriptors of ligands, if computed
+        already
+    """
+    if descriptors is None:
+        descriptors = ligand_descriptors(ligands)
+    search = search_parameters(params)
+    count = len(ligands)
+    return dict(
+        torsions=descriptors["torsions"],
+        heavy_atoms=descriptors["heavy_atoms"],
+        box_volume=np.full(
+            count, search["size_x"] * search["size_y"] * search["size_z"]
+        ),
+        exhaustiveness=np.full(count, search["exhaustiveness"]),
+        cpu=np.full(count, cpu or available_cpus()),
+    )
+
+
+def scoring_argument(params):
+    """
+    Return the vina command argument selecting the scoring function in
+    params, which is left out for the default so that vina versions before
+    1.2 keep working.
+    """
+    scoring = scoring_function(params)
+    return "" if scoring == "vina" else f"--scoring {scoring}"
+
+
+def receptor_maps(receptor, prefix, params, timeout=None):
+    """
+    Compute the vina grid maps of receptor for the search box in params
+    once and write them to files starting with prefix, so that ligands can
+    be docked against them with run_vina(maps=prefix) instead of each
+    recomputing them. Returns prefix. Raises a VinaError if the maps could
+    not be written, as with vina versions before 1.2.
+    """
+    search = search_parameters(params)
+    maps_cmd = f"""vina \\
+            --receptor {receptor} \\
+            {scoring_argument(params)} \\
+            --center_x {search["center_x"]} \\
+            --center_y {search["center_y"]} \\
+            --center_z {search["center_z"]} \\
+            --size_x {search["size_x"]} \\
+            --size_y {search["size_y"]} \\
+            --size_z {search["size_z"]} \\
+            --force_even_voxels \\
+            --write_maps {prefix}
+        """
     with subprocess.Popen(
-        ligand_obabel_cmd,
+        maps_cmd,
         shell=True,
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
+        start_new_session=True,
     ) as proc:
-        proc.communicate()
-    return f"{ligand}.pdbqt"
+        _, stderr = communicate(proc, timeout=timeout)
+    if proc.returncode != 0 or not os.path.exists(f"{prefix}.C_H.map"):
+        raise VinaError(
+            f"vina could not write maps for receptor {receptor}: "
+            f"{stderr.decode(errors='replace').strip()[-1000:]}"
+        )
+    return prefix
 
 
-def run_vina(receptor, ligand, working_directory, params):
-    print(f"RUNNING VINA FOR RECEPTOR {receptor} AND LIGAND {ligand}")
-    center_x = params.get("center_x", 0)
-    center_y = params.get("center_y", 0)
-    center_z = params.get("center_x", 0)
-    size_x = params.get("size_x", 30)
-    size_y = params.get("size_y", 30)
-    size_z = params.get("size_z", 30)
-    seed = params.get("seed", 0)
-    exhaustiveness = params.get("exhaustiveness", 8)
-    num_modes = params.get("num_modes", 9)
-    energy_range = params.get("energy_range", 3)
+def vina_output_paths(receptor, ligand, working_directory):
+    """
+    Return the paths of the output PDBQT and the log of the docking of
+    ligand to receptor in working_directory.
+    """
     receptor_filename = os.path.split(receptor)[1]
     ligand_filename = os.path.split(ligand)[1]
-    log_filename = f"r{receptor_filename}-l{ligand_filename}.log"
-    log_path = os.path.join(working_directory, log_filename)
-    output_filename = f"r{receptor_filename}-l{ligand_filename}.pdbqt"
-    output_path = os.path.join(working_directory, output_filename)
+    prefix = os.path.join(
+        working_directory, f"r{receptor_filename}-l{ligand_filename}"
+    )
+    return f"{prefix}.pdbqt", f"{prefix}.log"
+
+
+def cached_vina_result(cache, key, output_path, log_path):
+    """
+    Copy the cached vina result under key, if any, to output_path and
+    log_path and return whether there was one.
+    """
+    hit = cache.get(key)
+    if not hit:
+        return False
+    logging.info(f"Using cached vina result {key} for {output_path}.")
+    copyfile(hit["out.pdbqt"], output_path)
+    copyfile(hit["log"], log_path)
+    return True
+
+
+def run_vina(
+    receptor,
+    ligand,
+    working_directory,
+    params,
+    cpu=None,
+    cache=None,
+    timeout=None,
+    maps=None,
+):
+    """
+    Dock ligand to receptor with vina and return the paths of the output
+    PDBQT and the log. If a DiskCache is given, a previous result for the
+    same inputs is copied from it instead of running vina. Vina is killed
+    after timeout seconds, raising subprocess.TimeoutExpired, and a VinaError
+    is raised if it fails. The receptor grid maps are loaded from the
+    prefix maps written by receptor_maps if it is given. With the
+    score_only mode, which writes no poses, the scored input pose is the
+    output. vina 1.2 and later have no --log, so their standard output is
+    written to the log instead.
+    """
+    search = search_parameters(params)
+    center_x = search["center_x"]
+    center_y = search["center_y"]
+    center_z = search["center_z"]
+    size_x = search["size_x"]
+    size_y = search["size_y"]
+    size_z = search["size_z"]
+    seed = search["seed"]
+    exhaustiveness = search["exhaustiveness"]
+    num_modes = search["num_modes"]
+    energy_range = search["energy_range"]
+    output_path, log_path = vina_output_paths(
+        receptor, ligand, working_directory
+    )
+    if cache is not None:
+        key = docking_cache_key(receptor, ligand, params, maps)
+        if cached_vina_result(cache, key, output_path, log_path):
+            return output_path, log_path
+    print(f"RUNNING VINA FOR RECEPTOR {receptor} AND LIGAND {ligand}")
+    cpu_arg = f"--cpu {cpu}" if cpu else ""
+    receptor_arg = f"--maps {maps}" if maps else f"--receptor {receptor}"
+    log_arg = f"--log {log_path}" if vina_has_log() else ""
     vina_cmd = f"""vina \\
-            --receptor {receptor} \\
+            {receptor_arg} \\
+            {scoring_argument(params)} \\
+            {DOCKING_MODES[docking_mode(params)]} \\
             --ligand {ligand} \\
             --center_x {center_x} \\
             --center_y {center_y} \\
@@ -114,19 +1016,324 @@ def run_vina(receptor, ligand, working_directory, params):
             --size_y {size_y} \\
             --size_z {size_z} \\
             --out {output_path} \\
-            --log {log_path} \\
+            {log_arg} \\
             --seed {seed} \\
             --exhaustiveness {exhaustiveness} \\
             --num_modes {num_modes} \\
             --energy_range {energy_range} \\
+            {cpu_arg}
         """
+    if os.path.exists(output_path):
+        # Remove the output of an earlier attempt.
+        os.remove(output_path)
     with subprocess.Popen(
-        vina_cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        vina_cmd,
+        shell=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        # Run vina in its own process group so that a timeout kills it too.
+        start_new_session=True,
     ) as proc:
-        proc.communicate()
+        stdout, stderr = communicate(proc, timeout=timeout)
+    if not log_arg:
+        with open(log_path, "wb") as f:
+            f.write(stdout)
+    if proc.returncode == 0 and docking_mode(params) == "score_only":
+        copyfile(ligand, output_path)
+    if proc.returncode != 0 or not os.path.exists(output_path):
+        raise VinaError(
+            f"vina exited with code {proc.returncode} for ligand {ligand}: "
+            f"{stderr.decode(errors='replace').strip()[-1000:]}"
+        )
+    if cache is not None:
+        cache.put(key, {"out.pdbqt": output_path, "log": log_path})
+    return output_path, log_path
+
+
+def run_vina_embedded(
+    receptor,
+    ligand,
+    working_directory,
+    params,
+    cpu=None,
+    cache=None,
+    timeout=None,
+    maps=None,
+):
+    """
+    Dock ligand to receptor like run_vina, with the vina Python package in
+    this process rather than the vina command. The receptor and its grid
+    maps stay loaded in each thread between dockings. The output PDBQT and
+    a log of the binding modes are written as by run_vina, and
+    the runtime of vina is recorded as vina_seconds in the current
+    measurement. A docking in process cannot be interrupted, so a timeout
+    raises ValueError. maps is ignored since the engine keeps its maps in
+    memory.
+    """
+    if timeout:
+        raise ValueError("A docking in process can not be interrupted.")
+    output_path, log_path = vina_output_paths(
+        receptor, ligand, working_directory
+    )
+    if cache is not None:
+        key = docking_cache_key(receptor, ligand, params)
+        if cached_vina_result(cache, key, output_path, log_path):
+            return output_path, log_path
+    with open(ligand) as f:
+        ligand_pdbqt = f.read()
+    mode = docking_mode(params)
+    search = search_parameters(params)
+    start = time.perf_counter()
+    try:
+        if mode == "dock":
+            result = embedded.dock(
+                receptor,
+                ligand_pdbqt,
+                search,
+                cpu=cpu,
+                scoring=scoring_function(params),
+            )
+        else:
+            result = embedded.score(
+                receptor,
+                ligand_pdbqt,
+                search,
+                cpu=cpu,
+                scoring=scoring_function(params),
+                mode=mode,
+            )
+    except (RuntimeError, TypeError, ValueError) as exc:
+        raise VinaError(f"vina failed for ligand {ligand}: {exc}")
+    record = measurement()
+    if record is not None:
+        record["vina_seconds"] = time.perf_counter() - start
+    with open(output_path, "w") as f:
+        f.write(result["poses"])
+    with open(log_path, "w") as f:
+        f.write(vina_log(result["modes"], mode, search["seed"]))
+    if cache is not None:
+        cache.put(key, {"out.pdbqt": output_path, "log": log_path})
     return output_path, log_path
 
 
+class DockingEngine:
+    """
+    A docking backend: a function docking like run_vina, with a scoring
+    function. Every engine writes the output PDBQT and a log with the table
+    of binding modes of vina, read with parse_vina_log, and returns their
+    paths, so that the results of all engines share one schema.
+    param: capabilities - what the engine supports: "grid_maps" to dock
+        against the maps of receptor_maps, "timeout" to be interrupted
+        after vina_timeout seconds, "in_process" to run in this process,
+        and the DOCKING_MODES other than "dock" it can run
+    param: cost - the relative cost of the search compared with vina
+        scoring as "search", and the seconds spent outside the search once
+        per docking as "docking_seconds" and once per receptor, search box
+        and thread as "setup_seconds"
+    param: available - a function returning whether the engine can run
+        here, by default always
+    param: fallback - the name of the engine used when it can not
+    param: version - a function returning the version of the software the
+        engine docks with, which enters the keys of its dockings
+    """
+
+    def __init__(
+        self,
+        name,
+        function,
+        description,
+        scoring="vina",
+        capabilities=(),
+        cost=None,
+        available=None,
+        fallback=None,
+        version=None,
+    ):
+        self.name = name
+        self.function = function
+        self.description = description
+        self.scoring = scoring
+        self.capabilities = frozenset(capabilities)
+        self.cost = dict(
+            dict(search=1.0, docking_seconds=0.0, setup_seconds=0.0),
+            **(cost or {}),
+        )
+        self._available = available
+        self.fallback = fallback
+        self._version = version
+
+    def available(self):
+        return self._available is None or self._available()
+
+    def version(self):
+        """Return the version of the docking software as a string, or None."""
+        version = self._version() if self._version else None
+        if isinstance(version, tuple):
+            version = ".".join(map(str, version))
+        return version
+
+    def parameters(self, params):
+        """Return params with the engine and its scoring function."""
+        return dict(params, engine=self.name, scoring=self.scoring)
+
+    def dock(self, receptor, ligand, working_directory, params, **kwargs):
+        """Dock ligand to receptor like run_vina with this engine."""
+        return self.function(
+            receptor,
+            ligand,
+            working_directory,
+            self.parameters(params),
+            **kwargs,
+        )
+
+    def profile(self):
+        """Return the capabilities and cost of the engine."""
+        return dict(
+            name=self.name,
+            description=self.description,
+            scoring=self.scoring,
+            capabilities=sorted(self.capabilities),
+            cost=self.cost,
+            available=self.available(),
+            version=self.version(),
+        )
+
+
+# The docking engines by name.
+DOCKING_ENGINES = {}
+
+
+def register_engine(engine):
+    """Add a DockingEngine to DOCKING_ENGINES and return it."""
+    DOCKING_ENGINES[engine.name] = engine
+    return engine
+
+
+def docking_engine(name=None):
+    """
+    Return the DockingEngine of the engine parameter, "cli" by default, or
+    its fallback if it can not run here. Raises ValueError if neither can.
+    """
+    if (name or "cli") not in DOCKING_ENGINES:
+        raise ValueError(f"Unknown docking engine {name}.")
+    engine = DOCKING_ENGINES[name or "cli"]
+    while not engine.available() and engine.fallback:
+        engine = DOCKING_ENGINES[engine.fallback]
+    if not engine.available():
+        raise ValueError(
+            f"The {name} docking engine can not run here: "
+            f"{engine.description} is not installed."
+        )
+    return engine
+
+
+def vina_version():
+    """
+    Return the version of the vina command as a tuple of integers, or None
+    if it is not installed.
+    """
+    return command_version(which("vina"))
+
+
+@lru_cache(maxsize=None)
+def command_version(path):
+    """
+    Return the version of the vina command at path, "AutoDock Vina 1.1.2" or
+    "AutoDock Vina v1.2.5" in the output of vina --version, as a tuple of
+    integers, or None.
+    """
+    if path is None:
+        return None
+    try:
+        proc = subprocess.run(
+            [path, "--version"], capture_output=True, text=True, timeout=30
+        )
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    match = re.search(r"Vina v?(\d+(?:\.\d+)+)", proc.stdout + proc.stderr)
+    return tuple(map(int, match.group(1).split("."))) if match else None
+
+
+def vina_has_log():
+    """
+    Return whether the vina command takes --log, which was removed in
+    version 1.2. A vina whose version is unknown is assumed to take it.
+    """
+    version = vina_version()
+    return version is None or version < (1, 2)
+
+
+def vina_has_scoring():
+    """
+    Return whether the vina command takes --scoring, which it does from
+    version 1.2.
+    """
+    version = vina_version()
+    return version is not None and version >= (1, 2)
+
+
+# The costs were measured with the search box of the tests on 6wzu: the
+# vina command spends 1.8 seconds per docking computing or loading the
+# grid maps, the Python package computes the maps of every atom type once,
+# and Vinardo searches in 0.85 of the time of the vina scoring function.
+register_engine(
+    DockingEngine(
+        "cli",
+        run_vina,
+        "the vina command",
+        capabilities=("grid_maps", "local_only", "score_only", "timeout"),
+        cost=dict(docking_seconds=1.8),
+        version=vina_version,
+    )
+)
+register_engine(
+    DockingEngine(
+        "python",
+        run_vina_embedded,
+        "the vina Python package",
+        capabilities=("in_process", "local_only", "score_only"),
+        cost=dict(setup_seconds=4.4),
+        available=embedded.available,
+        fallback="cli",
+        version=embedded.version,
+    )
+)
+register_engine(
+    DockingEngine(
+        "vinardo",
+        run_vina_embedded,
+        "Vinardo scoring with the vina Python package",
+        scoring="vinardo",
+        capabilities=("in_process", "local_only", "score_only"),
+        cost=dict(search=0.85, setup_seconds=3.6),
+        available=embedded.available,
+        fallback="vinardo_cli",
+        version=embedded.version,
+    )
+)
+register_engine(
+    DockingEngine(
+        "vinardo_cli",
+        run_vina,
+        "Vinardo scoring with the vina command, version 1.2 or later",
+        scoring="vinardo",
+        capabilities=("grid_maps", "local_only", "score_only", "timeout"),
+        cost=dict(search=0.85, docking_seconds=1.8),
+        available=vina_has_scoring,
+        version=vina_version,
+    )
+)
+
+
+MAX_CONCURRENT_DOWNLOADS = 8
+# The shares of cache_max_bytes given to the docking results, the prepared
+# receptors and the ligand PDBQT files cached in cache_dir. The cost model
+# stored there is small, with at most CostModel.max_observations entries.
+CACHE_SHARES = dict(vina_results=0.6, receptors=0.3, ligands=0.1)
+# The most ligands the filters are applied to in one vectorized pass.
+FILTER_BATCH_SIZE = 64
+# The dockings handed to the workers of a spool at a time.
+SPOOL_TASKS_IN_FLIGHT = 64
 MODULE_DIR = "/kb/module"
 TEMPLATES_DIR = os.path.join(MODULE_DIR, "lib/templates")
 
@@ -147,8 +1354,71 @@ class ADVinaApp(Core):
         # self.shared_folder is defined in the Core App class.
         # a cache for Workspace.get_objects2 results
         self.ws_cache = {}
+        # the titles of the molecules split from each CompoundSet
+        self.ligand_names = {}
+        # the ligands which could not be docked and which were filtered out
+        self.failures = []
+        self.skipped = []
+        # the docking sites of each receptor and the pockets they were
+        # found in
+        self.sites = {}
+        self.pockets = []
+        # the prepared receptors by reference/upa
+        self.receptor_filenames = {}
+        # the prefixes of the grid maps of each receptor and search box
+        self.grid_maps = {}
+        self._grid_maps_lock = threading.Lock()
+        # the molecule_key of each ligand, the first ligand of each
+        # molecule and the duplicates of each such ligand
+        self.molecule_keys = {}
+        self.unique_ligands = {}
+        self.duplicates = {}
+        self._duplicates_lock = threading.Lock()
+        # timing and resource usage of each stage
+        self.instrumentation = Instrumentation()
+        # the spool through which dockings are distributed to workers, and
+        # the workers started on this host
+        self.spool = None
+        self.spool_workers = []
         self.reports_path = os.path.join(self.shared_folder, "reports")
         self._prepare_report_directory()
+        # Completed dockings are recorded so that a re-run of the same job
+        # continues where it stopped.
+        self.manifest = CheckpointManifest(
+            os.path.join(self.vina_output_shared, "manifest.jsonl")
+        )
+        # Docking results are cached between jobs when a cache directory is
+        # configured.
+        self.cache_dir = config.get("cache_dir")
+        self.cache_max_bytes = config.get("cache_max_bytes", 10 * 2**30)
+        self.result_cache = None
+        self.receptor_cache = None
+        self.ligand_cache = None
+        # Runtimes are modelled to dock the most expensive ligands first,
+        # learning from earlier jobs when a cache directory is configured.
+        self.cost_model = CostModel(
+            os.path.join(self.cache_dir, "cost_model.json")
+            if self.cache_dir
+            else None
+        )
+        if self.cache_dir:
+            # The caches share cache_max_bytes.
+            budget = {
+                name: int(share * self.cache_max_bytes)
+                for name, share in CACHE_SHARES.items()
+            }
+            self.result_cache = DiskCache(
+                os.path.join(self.cache_dir, "vina_results"),
+                budget["vina_results"],
+            )
+            self.receptor_cache = DiskCache(
+                os.path.join(self.cache_dir, "receptors"),
+                budget["receptors"],
+            )
+            self.ligand_cache = PackCache(
+                os.path.join(self.cache_dir, "ligands.sqlite"),
+                budget["ligands"],
+            )
 
     def _prepare_report_directory(self):
         self.ligands_input = "ligands_input"
@@ -158,6 +1428,12 @@ class ADVinaApp(Core):
         os.makedirs(
             os.path.join(self.reports_path, self.ligands_input), exist_ok=True
         )
+        self.instrumentation_filename = "instrumentation.json"
+        self.prescreen_output = "vina_prescreen"
+        self.prescreen_output_shared = os.path.join(
+            self.reports_path, self.prescreen_output
+        )
+        os.makedirs(self.prescreen_output_shared, exist_ok=True)
         self.vina_output = "vina_output"
         self.vina_output_shared = os.path.join(
             self.reports_path, self.vina_output
@@ -170,27 +1446,106 @@ class ADVinaApp(Core):
         """
         This method is where the main computation will occur.
         """
-        receptor_ref = params.get("receptor_ref")
+        receptor_refs = receptor_references(params)
         ligand_refs = params.get("ligand_refs")
-        # Download the receptor and ligands from KBase.
-        resp_receptor_orig = self.download_receptor(receptor_ref)
-        resp_ligands_orig = self.download_ligands(ligand_refs)
-        # Convert inputs to PDBQT.
-        receptor_path = self.receptor_as_pdbqt(resp_receptor_orig)
-        self.receptor_filename = os.path.split(receptor_path)[1]
-        ligand_filenames = self.ligands_as_pdbqts(resp_ligands_orig)
-        # Run AutoDock Vina on inputs.
-        output = self.run_vinas(receptor_path, ligand_filenames, params)
-        # Upload the resulting input and output PDBQT files.
+        engine = docking_engine(params.get("engine"))
+        if engine.name != (params.get("engine") or "cli"):
+            logging.warning(
+                f"The {params['engine']} docking engine can not run here, "
+                f"docking with {engine.description} instead."
+            )
+        mode = docking_mode(params)
+        if mode != "dock" and mode not in engine.capabilities:
+            raise ValueError(
+                f"The {engine.name} docking engine can not run {mode}."
+            )
+        if params.get("vina_timeout") and "timeout" not in engine.capabilities:
+            # An in-process docking can not be interrupted.
+            raise ValueError(
+                f"The {engine.name} docking engine does not support "
+                "vina_timeout."
+            )
+        self.start_spool(params)
+        try:
+            self.cache_ligand_objects(ligand_refs)
+            with ThreadPoolExecutor(
+                max_workers=min(MAX_CONCURRENT_DOWNLOADS, len(receptor_refs))
+            ) as executor:
+                receptor_pdbs = dict(
+                    zip(
+                        receptor_refs,
+                        executor.map(self.download_receptor, receptor_refs),
+                    )
+                )
+            self.sites = {
+                receptor_ref: self.docking_sites(params, receptor_pdb)
+                for receptor_ref, receptor_pdb in receptor_pdbs.items()
+            }
+            if len(receptor_refs) == 1 and "" in self.sites[receptor_refs[0]]:
+                # Report the search box of a single receptor with the params.
+                params = dict(params, **self.sites[receptor_refs[0]][""])
+            with ThreadPoolExecutor(
+                max_workers=len(receptor_refs)
+            ) as executor:
+                # Convert the receptors to PDBQT while the ligands are
+                # downloaded.
+                receptors = {
+                    receptor_ref: executor.submit(
+                        self.prepare_receptor, receptor_pdb
+                    )
+                    for receptor_ref, receptor_pdb in receptor_pdbs.items()
+                }
+                # Download, convert, dock and parse each ligand in a pipeline,
+                # docking each ligand to every receptor. In a two-stage screen
+                # every ligand is first docked cheaply.
+                prescreen = screening_parameters(params)
+                pipeline = self.docking_pipeline(
+                    receptors,
+                    ligand_refs,
+                    prescreen or params,
+                    working_directory=(
+                        self.prescreen_output_shared if prescreen else None
+                    ),
+                )
+                results = pipeline.run(ligand_refs)
+            pipeline.log_stats()
+            prescreen_logs = {}
+            if prescreen:
+                # Re-dock the best ligands with the requested parameters.
+                screened = results
+                results = self.refine(
+                    {
+                        receptor_ref: receptor.result()
+                        for receptor_ref, receptor in receptors.items()
+                    },
+                    results,
+                    params,
+                )
+                prescreen_logs = {
+                    log: logdata
+                    for _, log, logdata in self.fan_out_duplicates(screened)
+                }
+        finally:
+            self.stop_spool()
+        results = self.fan_out_duplicates(results)
+        self.fan_out_duplicate_records()
+        self.cost_model.save()
+        output = [(pdbqt, log) for pdbqt, log, _ in results]
+        logs = {log: logdata for _, log, logdata in results}
         # Generate the report.
-        return self.generate_report(output, params)
+        return self.generate_report(
+            output,
+            params,
+            logs=logs,
+            pipeline_stats=pipeline.stats(),
+            prescreen_logs=prescreen_logs,
+        )
 
-    def download_ligands(self, ligand_refs):
+    def cache_ligand_objects(self, ligand_refs):
         """
-        Download a list of CompoundSet objects
+        Fetch the CompoundSet objects of ligand_refs into self.ws_cache
         param: ligands_ref - A list of ligands references/upas
         """
-        ligands = []
         ligand_ref_objs = [{"ref": ligand_ref} for ligand_ref in ligand_refs]
         ligand_objects = self.ws.get_objects2({"objects": ligand_ref_objs})[
             "data"
@@ -200,7 +1555,272 @@ class ADVinaApp(Core):
             for ligand_object in ligand_objects
         }
         self.ws_cache.update(responses)
-        for ligand_ref in ligand_refs:
+
+    def cache_receptor(self, receptor_ref, receptor, receptor_pdbqt):
+        """
+        Store a downloaded and prepared receptor in the receptor cache.
+        param: receptor_ref - the receptor reference/upa
+        param: receptor - the local copy of the receptor in PDB format
+        param: receptor_pdbqt - the prepared receptor
+        """
+        if not os.path.getsize(receptor_pdbqt):
+            # An empty receptor would fail every later job.
+            return
+        metadata = dict(
+            receptor_ref=receptor_ref,
+            preparation_version=RECEPTOR_PREPARATION_VERSION,
+            openbabel_version=openbabel_version(),
+            pdbqt_bytes=os.path.getsize(receptor_pdbqt),
+        )
+        metadata_path = os.path.join(
+            self.shared_folder, f"{os.path.split(receptor)[1]}.json"
+        )
+        with open(metadata_path, "w") as f:
+            json.dump(metadata, f)
+        self.receptor_cache.put(
+            receptor_cache_key(receptor_ref),
+            {
+                "metadata.json": metadata_path,
+                "receptor.pdb": receptor,
+                "receptor.pdbqt": receptor_pdbqt,
+            },
+        )
+        os.remove(metadata_path)
+
+    def cached_receptor(self, receptor_ref):
+        """
+        Return the files of a receptor in the receptor cache, the original
+        PDB as receptor.pdb, the prepared receptor.pdbqt and the JSON
+        metadata.json, or None if it is not cached.
+        param: receptor_ref - the receptor reference/upa
+        """
+        if self.receptor_cache is None:
+            return None
+        key = receptor_cache_key(receptor_ref)
+        hit = self.receptor_cache.get(key)
+        if hit:
+            logging.info(f"Using cached receptor {key} for {receptor_ref}.")
+        return hit
+
+    def docking_cpus(self, num_tasks, params):
+        """
+        Return the number of concurrent dockings and the cpus of each for
+        num_tasks dockings with params, like allocate_cpus. The vina Python
+        package holds the GIL while it docks, so the dockings of an engine
+        running in this process are run one at a time with the threads of
+        vina on all the cores, unless they go to the processes of a spool.
+        """
+        engine = docking_engine(params.get("engine"))
+        if "in_process" in engine.capabilities and not self.spool:
+            num_tasks = 1
+        return allocate_cpus(
+            num_tasks, search_threads(params), params.get("max_cpus")
+        )
+
+    def count_molecules(self, ligand_refs):
+        """
+        Return the number of molecules in the cached CompoundSet objects of
+        ligand_refs.
+        """
+        return sum(
+            len(self.ws_cache.get(ligand_ref, {}).get("compounds", [])) or 1
+            for ligand_ref in ligand_refs
+        )
+
+    def docking_pipeline(
+        self, receptors, ligand_refs, params, working_directory=None
+    ):
+        """
+        Return a Pipeline which downloads each CompoundSet, splits it into
+        molecules, converts each molecule to PDBQT, skips it if it fails
+        the ligand filters, docks it to each site of each receptor, those
+        the cost model predicts to take longest first, and parses the vina
+        output.
+        param: receptors - a dictionary of futures of the receptor PDBQT
+            filenames by receptor reference/upa
+        param: ligand_refs - A list of ligands references/upas
+        param: working_directory - where vina writes its output, by default
+            self.vina_output_shared
+        """
+        targets = [
+            (receptor_ref, site)
+            for receptor_ref, sites in self.sites.items()
+            for site in sites
+        ]
+        workers, cpu = self.docking_cpus(
+            self.count_molecules(ligand_refs) * len(targets), params
+        )
+        logging.info(
+            f"Docking with {workers} concurrent vina processes using {cpu} "
+            "cpus each."
+        )
+        dock_workers = SPOOL_TASKS_IN_FLIGHT if self.spool else workers
+
+        def download(ligand_ref):
+            return list(self.split_ligand(self.download_ligand(ligand_ref)))
+
+        def convert(ligand_filename):
+            if self.deduplicate(ligand_filename):
+                return []
+            try:
+                return [self.ligand_as_pdbqt(ligand_filename)]
+            except ConversionError as exc:
+                # Failed ligands leave the pipeline here.
+                self.record_failure(
+                    f"{ligand_filename}.pdbqt", "ligand_as_pdbqt", str(exc)
+                )
+                return []
+
+        def select(ligand_filenames):
+            descriptors = ligand_descriptors(ligand_filenames)
+            selected = set(
+                self.filter_ligands(ligand_filenames, params, descriptors)
+            )
+            costs = {
+                target: self.cost_model.predict(
+                    docking_features(
+                        ligand_filenames,
+                        dict(params, **self.sites[target[0]][target[1]]),
+                        cpu,
+                        descriptors,
+                    )
+                )
+                for target in targets
+            }
+            # Each ligand is docked to every site separately, with the
+            # predicted cost of the docking.
+            return [
+                [
+                    (ligand_filename, *target, float(costs[target][index]))
+                    for target in targets
+                ]
+                if ligand_filename in selected
+                else []
+                for index, ligand_filename in enumerate(ligand_filenames)
+            ]
+
+        def dock(task):
+            ligand_filename, receptor_ref, site, _ = task
+            output = self.run_vina(
+                receptors[receptor_ref].result(),
+                ligand_filename,
+                dict(params, **self.sites[receptor_ref][site]),
+                cpu=cpu,
+                working_directory=self.site_directory(
+                    working_directory or self.vina_output_shared, site
+                ),
+            )
+            # Failed ligands leave the pipeline here.
+            return [] if output is None else [(output, site)]
+
+        def parse(task):
+            (pdbqt, log), site = task
+            logdata = self.process_vina_output(
+                pdbqt, log, docking_mode(params)
+            )
+            logdata["site"] = site
+            return pdbqt, log, logdata
+
+        return Pipeline(
+            [
+                Stage(
+                    "download",
+                    download,
+                    workers=min(MAX_CONCURRENT_DOWNLOADS, len(ligand_refs)),
+                    fan_out=True,
+                ),
+                Stage("convert", convert, workers=workers, fan_out=True),
+                # The filters run on whatever ligands are waiting at once.
+                Stage(
+                    "filter",
+                    select,
+                    fan_out=True,
+                    batch_size=FILTER_BATCH_SIZE,
+                ),
+                # The dockings waiting are run most expensive first, so
+                # that no long docking is left running alone at the end.
+                Stage(
+                    "dock",
+                    dock,
+                    workers=dock_workers,
+                    maxsize=max(
+                        2 * dock_workers, FILTER_BATCH_SIZE * len(targets)
+                    ),
+                    fan_out=True,
+                    priority=lambda task: -task[3],
+                ),
+                Stage("parse", parse),
+            ]
+        )
+
+    def deduplicate(self, ligand_filename):
+        """
+        Return True if the molecule of a ligand was already seen in this
+        job, recording the ligand as a duplicate of the first ligand with
+        the same structure so that it is only docked once.
+        param: ligand_filename - the ligand SDF filename
+        """
+        key = molecule_key(ligand_filename)
+        with self._duplicates_lock:
+            self.molecule_keys[ligand_filename] = key
+            if key is None:
+                return False
+            first = self.unique_ligands.setdefault(key, ligand_filename)
+            if first == ligand_filename:
+                return False
+            self.duplicates.setdefault(first, []).append(ligand_filename)
+        logging.info(f"Docking {ligand_filename} once as {first}.")
+        return True
+
+    def docking_sites(self, params, receptor):
+        """
+        Return a dictionary of the sites of a receptor to dock each ligand
+        to, mapping the name of each site to its search box parameters.
+        With the "pockets" box_mode these are the num_pockets best pockets
+        found on the receptor, otherwise there is one unnamed site using
+        the search box of search_box_parameters.
+        param: receptor - the local copy of a receptor object in PDB format
+        """
+        if params.get("box_mode") != "pockets":
+            box = self.search_box_parameters(params, receptor)
+            return {
+                "": {
+                    name: value
+                    for name, value in box.items()
+                    if name.startswith(("center_", "size_"))
+                }
+            }
+        atoms = read_pdb_atoms(receptor)
+        pockets = detect_pockets(
+            atoms["coordinates"][atoms["record"] == "ATOM"]
+        )[: int(params.get("num_pockets") or 3)]
+        if not pockets:
+            raise ValueError("No pockets were found on the receptor.")
+        margin = float(params.get("box_margin") or 4.0)
+        sites = {}
+        for rank, pocket in enumerate(pockets, 1):
+            name = f"pocket{rank}"
+            sites[name] = search_box(pocket["coordinates"], margin)
+            self.pockets.append(
+                dict(
+                    sites[name],
+                    name=name,
+                    receptor_ref=decode_upa_filename(
+                        os.path.split(receptor)[1]
+                    ),
+                    score=pocket["score"],
+                    volume=pocket["volume"],
+                )
+            )
+        logging.info(f"Docking to the pockets {sites}.")
+        return sites
+
+    def download_ligand(self, ligand_ref):
+        """
+        Download a CompoundSet object as an SDF file
+        param: ligand_ref - the ligand reference/upa
+        """
+        with self.instrumentation.measure("download_ligand", ligand_ref):
             out = self.csu.compound_set_to_file(
                 {
                     "compound_set_ref": ligand_ref,
@@ -210,27 +1830,137 @@ class ADVinaApp(Core):
             src = out["file_path"]
             dst_filename = f"{encode_upa_filename(ligand_ref)}.sdf"
             dst = os.path.join(self.ligands_input_shared, dst_filename)
-            ligands.append(copyfile(src, dst))
-        return ligands
+            return copyfile(src, dst)
+
+    def download_ligands(self, ligand_refs):
+        """
+        Download a list of CompoundSet objects
+        param: ligands_ref - A list of ligands references/upas
+        """
+        self.cache_ligand_objects(ligand_refs)
+        workers = max(1, min(MAX_CONCURRENT_DOWNLOADS, len(ligand_refs)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(self.download_ligand, ligand_refs))
 
     def download_receptor(self, receptor_ref):
         """
         Download a receptor ModelProteinStructure object
         param: receptor_ref - the receptor reference/upa
         """
-        out = self.psu.export_pdb_structures({"input_ref": receptor_ref})
-        out_filename = f"{encode_upa_filename(receptor_ref)}.pdb"
-        out_path = os.path.join(self.reports_path, out_filename)
-        self.dfu.shock_to_file(
-            {
-                "file_path": out_path,
-                "shock_id": out["shock_id"],
-                "unpack": "uncompress",
-            }
-        )
-        return out_path
+        with self.instrumentation.measure("download_receptor", receptor_ref):
+            out_filename = f"{encode_upa_filename(receptor_ref)}.pdb"
+            out_path = os.path.join(self.reports_path, out_filename)
+            hit = self.cached_receptor(receptor_ref)
+            if hit:
+                copyfile(hit["receptor.pdb"], out_path)
+                return out_path
+            out = self.psu.export_pdb_structures({"input_ref": receptor_ref})
+            self.dfu.shock_to_file(
+                {
+                    "file_path": out_path,
+                    "shock_id": out["shock_id"],
+                    "unpack": "uncompress",
+                }
+            )
+            return out_path
+
+    def fan_out_duplicates(self, results):
+        """
+        Return the docking results with a result for every duplicate of a
+        docked ligand following the result of that ligand. The output of
+        the docked ligand is copied to the names of each duplicate, so that
+        process_vina_output attributes it to the ref and compound name the
+        duplicate came from.
+        param: results - a list of (pdbqt, log, logdata) results
+        """
+        fanned = []
+        for pdbqt, log, logdata in results:
+            fanned.append((pdbqt, log, logdata))
+            ligand_pdbqt = os.path.join(
+                self.reports_path, logdata["ligand_pdbqt_input"]
+            )
+            ligand = ligand_pdbqt[: -len(".pdbqt")]
+            for duplicate in self.duplicates.get(ligand, []):
+                name = os.path.split(ligand)[1]
+                duplicate_name = os.path.split(duplicate)[1]
+                paths = []
+                for path in (ligand_pdbqt, pdbqt, log):
+                    directory, filename = os.path.split(path)
+                    paths.append(
+                        os.path.join(
+                            directory, filename.replace(name, duplicate_name)
+                        )
+                    )
+                    copyfile(path, paths[-1])
+                duplicate_logdata = self.process_vina_output(
+                    *paths[1:], logdata["mode"]
+                )
+                for field in ("site", "refined"):
+                    if field in logdata:
+                        duplicate_logdata[field] = logdata[field]
+                duplicate_logdata["duplicate_of"] = logdata["name"]
+                fanned.append((*paths[1:], duplicate_logdata))
+        return fanned
+
+    def filter_ligands(self, ligand_filenames, params, descriptors=None):
+        """
+        Return the ligands which pass the ligand filters in params, see
+        ligand_filter_reasons, and record the others as skipped so that
+        they are listed in the report. Ligands whose files can not be read
+        are recorded as failures.
+        param: ligand_filenames - a list of ligand PDBQT filenames
+        param: descriptors - the ligand_descriptors of the ligands, if
+            computed already
+        """
+        if not any(params.get(name) for name in LIGAND_FILTERS):
+            return ligand_filenames
+        if descriptors is None:
+            descriptors = ligand_descriptors(ligand_filenames)
+        reasons = ligand_filter_reasons(descriptors, params)
+        selected = []
+        for ligand_filename, reason, error in zip(
+            ligand_filenames, reasons, descriptors["errors"]
+        ):
+            if error:
+                logging.warning(f"Skipping {ligand_filename}: {error}")
+                self.record_failure(ligand_filename, "filter", error)
+            elif reason:
+                logging.info(f"Skipping {ligand_filename}: {reason}")
+                self.skipped.append(
+                    self.ligand_record(ligand_filename, reason=reason)
+                )
+            else:
+                selected.append(ligand_filename)
+        return selected
+
+    def fan_out_duplicate_records(self):
+        """
+        List the duplicates of each failed or skipped ligand in the report
+        with the same error or reason.
+        """
+        for records in (self.failures, self.skipped):
+            for record in list(records):
+                ligand = os.path.join(
+                    self.ligands_input_shared,
+                    record["ligand_filename"][: -len(".pdbqt")],
+                )
+                for duplicate in self.duplicates.get(ligand, []):
+                    records.append(
+                        dict(
+                            record,
+                            **self.ligand_record(f"{duplicate}.pdbqt"),
+                            duplicate_of=record["name"],
+                        )
+                    )
 
-    def generate_report(self, output, params: dict):
+    def generate_report(
+        self,
+        output,
+        params: dict,
+        logs=None,
+        pipeline_stats=None,
+        prescreen_logs=None,
+    ):
         """
         This method is where to define the variables to pass to the report.
         """
@@ -239,28 +1969,47 @@ class ADVinaApp(Core):
         # Path to the Jinja template. The template can be adjusted to change
         # the report.
         template_path = os.path.join(TEMPLATES_DIR, "report.html")
-        citation = self.get_vina_citation()
-        logs = {
-            log: self.process_vina_output(pdbqt, log) for (pdbqt, log) in output
-        }
+        citation = self.get_vina_citation(params)
+        if logs is None:
+            logs = {
+                log: self.process_vina_output(pdbqt, log)
+                for (pdbqt, log) in output
+            }
         affinitys = {log: logdata["affinity"] for log, logdata in logs.items()}
         # Create archives of output
-        oldpwd = os.getcwd()
-        os.chdir(self.ligands_input_shared)
-        make_archive(f"{self.ligands_input}", "zip")
-        os.chdir(self.vina_output_shared)
-        make_archive(f"{self.vina_output}", "zip")
-        os.chdir(oldpwd)
+        with self.instrumentation.measure("make_archive"):
+            oldpwd = os.getcwd()
+            os.chdir(self.ligands_input_shared)
+            make_archive(f"{self.ligands_input}", "zip")
+            os.chdir(self.vina_output_shared)
+            make_archive(f"{self.vina_output}", "zip")
+            os.chdir(oldpwd)
+        # Record the timing and resource usage of each stage next to the
+        # report.
+        self.instrumentation.log_summary()
+        self.instrumentation.write(
+            os.path.join(reports_path, self.instrumentation_filename)
+        )
         # The keys in this dictionary will be available as variables in the
         # Jinja template. With the current configuration of the template
         # engine, HTML output is allowed.
+        receptor_refs, matrix = affinity_matrix(list(logs.values()))
         template_variables = dict(
+            affinity_matrix=matrix,
             affinitys=affinitys,
+            failures=self.failures,
+            instrumentation=self.instrumentation_filename,
             ligands_input=self.ligands_input,
             logs=logs,
             output=output,
             params=params,
+            pipeline_stats=pipeline_stats or [],
+            pockets=self.pockets,
+            prescreen_logs=prescreen_logs or {},
             receptor=self.receptor_filename,
+            receptor_refs=receptor_refs,
+            receptors=self.receptor_filenames,
+            skipped=self.skipped,
             vina_output=self.vina_output,
         )
         # Parameters for create_extended_report
@@ -289,7 +2038,15 @@ class ADVinaApp(Core):
         )
         return self.create_report_from_template(template_path, config)
 
-    def get_vina_citation(self):
+    def get_vina_citation(self, params=None):
+        """
+        Return the citation of vina, as printed by the vina command, or the
+        citation of the vina Python package if the docking engine of params
+        runs in this process, since the command may not be installed then.
+        """
+        engine = docking_engine((params or {}).get("engine"))
+        if "in_process" in engine.capabilities:
+            return VINA_PACKAGE_CITATION
         cmd = textwrap.dedent(
             """
             vina \\
@@ -308,33 +2065,116 @@ class ADVinaApp(Core):
         assert len(stderr.decode().split("\n")) == 4
         return stdout.decode()
 
+    def ligand_as_pdbqt(self, ligand):
+        """
+        Convert a ligand SDF file into a PDBQT file
+        param: ligand - the local copy of a molecule
+        """
+        with self.instrumentation.measure(
+            "ligand_as_pdbqt", os.path.split(ligand)[1]
+        ):
+            if self.ligand_cache is None:
+                return ligand_as_pdbqt(ligand)
+            key = ligand_cache_key(ligand, self.molecule_keys.get(ligand))
+            pdbqt = self.ligand_cache.get(key) if key else None
+            if pdbqt is not None:
+                with open(f"{ligand}.pdbqt", "wb") as f:
+                    f.write(pdbqt)
+                return f"{ligand}.pdbqt"
+            out_filename = ligand_as_pdbqt(ligand)
+            if key and os.path.exists(out_filename):
+                with open(out_filename, "rb") as f:
+                    pdbqt = f.read()
+                if pdbqt:
+                    self.ligand_cache.put(key, pdbqt)
+            return out_filename
+
+    def ligand_record(self, ligand_filename, **fields):
+        """
+        Return a dictionary describing a ligand PDBQT file for the report,
+        with its name, compound set and ref and the given fields.
+        """
+        ligand_filename = os.path.split(ligand_filename)[1]
+        ligand_ref = decode_upa_filename(ligand_filename)
+        ligand_object = self.ws_cache.get(ligand_ref, {})
+        ligand_sdf = ligand_filename[: -len(".pdbqt")]
+        return dict(
+            fields,
+            compound_set=ligand_object.get("name"),
+            ligand_filename=ligand_filename,
+            ligand_ref=ligand_ref,
+            name=self.ligand_names.get(ligand_sdf, ligand_filename),
+        )
+
     def ligands_as_pdbqts(self, ligands):
         """
-        Convert a list of ligand SDF files into PDBQT files
+        Convert a list of ligand SDF files into PDBQT files, one for each
+        molecule in the SDF files.
         param: ligands - the local copy of a compound set
         """
-        return [ligand_as_pdbqt(ligand) for ligand in ligands]
+        return [
+            self.ligand_as_pdbqt(molecule)
+            for ligand in ligands
+            for molecule in self.split_ligand(ligand)
+        ]
+
+    def observe_runtime(self, ligand_filename, params, cpu, seconds):
+        """
+        Record the runtime of a docking in the cost model.
+        param: ligand_filename - the ligand PDBQT filename
+        """
+        features = docking_features([ligand_filename], params, cpu)
+        self.cost_model.observe(
+            seconds,
+            **{name: float(values[0]) for name, values in features.items()},
+        )
+
+    def prepare_receptor(self, receptor):
+        """
+        Convert a receptor to PDBQT and remember its filename for the report
+        param: receptor - the local copy of a receptor object
+        """
+        receptor_path = self.receptor_as_pdbqt(receptor)
+        self.receptor_filename = os.path.split(receptor_path)[1]
+        self.receptor_filenames[
+            decode_upa_filename(self.receptor_filename)
+        ] = self.receptor_filename
+        return receptor_path
 
-    def process_vina_output(self, pdbqt, log):
+    def process_vina_output(self, pdbqt, log, mode="dock"):
+        """
+        Return the logdata of the output of a vina run in one of the
+        DOCKING_MODES.
+        """
+        with self.instrumentation.measure(
+            "process_vina_output", os.path.split(log)[1]
+        ):
+            return self._process_vina_output(pdbqt, log, mode)
+
+    def _process_vina_output(self, pdbqt, log, mode):
         receptor, ligand = [
             "/".join(tup) for tup in re.findall(upa_filename_pattern, log)
         ]
         with open(os.path.join(self.shared_folder, log)) as f:
             log_data = f.read()
         ligand_object = self.ws_cache[ligand]
-        pdbqt_input = os.path.join(
-            self.ligands_input, f"{encode_upa_filename(ligand)}.sdf.pdbqt"
-        )
         log_filename = os.path.split(log)[1]
-        pdbqt_filename = os.path.split(pdbqt)[1]
-        pdbqt_output = f"{self.vina_output}/{pdbqt_filename}"
-        log_path = f"{self.vina_output}/{log_filename}"
+        # Output filenames are r{receptor_filename}-l{ligand_filename}.log
+        ligand_filename = re.match(r"r.*?-l(.*)\.log$", log_filename)[1]
+        ligand_sdf = ligand_filename[: -len(".pdbqt")]
+        pdbqt_input = os.path.join(self.ligands_input, ligand_filename)
+        pdbqt_output = os.path.relpath(pdbqt, self.reports_path)
+        log_path = os.path.relpath(log, self.reports_path)
+        modes = parse_vina_output(log_data, mode)
         return {
-            "affinity": get_affinity_from_vina_log(log_data),
+            "affinity": modes[0]["affinity"] if modes else None,
+            "mode": mode,
+            "modes": modes,
             "ligand_pdbqt_input": pdbqt_input,
             "ligand_pdbqt_output": pdbqt_output,
             "log_path": log_path,
-            "name": ligand_object["name"],
+            "compound_set": ligand_object["name"],
+            "name": self.ligand_names.get(ligand_sdf, ligand_object["name"]),
             "raw": log_data,
             "receptor_ref": receptor,
             "ligand_ref": ligand,
@@ -345,20 +2185,424 @@ class ADVinaApp(Core):
         Convert a receptor PDB file into a PDBQT file
         param: receptor - the local copy of a receptor objct
         """
-        return receptor_as_pdbqt(receptor)
+        with self.instrumentation.measure(
+            "receptor_as_pdbqt", os.path.split(receptor)[1]
+        ):
+            receptor_ref = decode_upa_filename(os.path.split(receptor)[1])
+            hit = self.cached_receptor(receptor_ref)
+            if hit:
+                out_filename = f"{receptor}qt"
+                copyfile(hit["receptor.pdbqt"], out_filename)
+                return out_filename
+            out_filename = receptor_as_pdbqt(receptor)
+            if self.receptor_cache is not None:
+                self.cache_receptor(receptor_ref, receptor, out_filename)
+            return out_filename
 
-    def run_vinas(self, receptor_filename, ligand_filenames, params):
+    def refine(self, receptors, results, params):
         """
-        Run AutoDock vina for each pair of receptor and ligand.
+        Select the best ligands of a pre-screen for each receptor and dock
+        them again with the requested parameters.
+        param: receptors - a dictionary of the receptor PDBQT filenames by
+            receptor reference/upa
+        param: results - the (pdbqt, log, logdata) results of the pre-screen
+        Returns the (pdbqt, log, logdata) results of the selected ligands.
+        """
+        # The best docking of each ligand to each receptor, over its sites.
+        best = {}
+        for index, (_, _, logdata) in enumerate(results):
+            if logdata["affinity"] is None:
+                continue
+            ligand = (logdata["receptor_ref"], logdata["ligand_pdbqt_input"])
+            if (
+                ligand not in best
+                or logdata["affinity"] < results[best[ligand]][2]["affinity"]
+            ):
+                best[ligand] = index
+        by_receptor = {}
+        for (receptor_ref, _), index in best.items():
+            by_receptor.setdefault(receptor_ref, []).append(index)
+        refined = set()
+        for indices in by_receptor.values():
+            selected = select_top_ligands(
+                [results[index][2]["affinity"] for index in indices],
+                top_k=params.get("screen_top_k"),
+                top_percent=params.get("screen_top_percent"),
+            )
+            refined.update(indices[index] for index in selected)
+        logging.info(
+            f"Refining {len(refined)} of {len(results)} pre-screened dockings."
+        )
+        # Each selected ligand is docked again at the site of its best
+        # docking, all in one batch so that no cpu waits for a site.
+        dockings = []
+        sites = []
+        for index, (_, _, logdata) in enumerate(results):
+            logdata["refined"] = index in refined
+            if not logdata["refined"]:
+                continue
+            receptor_ref, site = logdata["receptor_ref"], logdata["site"]
+            dockings.append(
+                (
+                    receptors[receptor_ref],
+                    os.path.join(
+                        self.reports_path, logdata["ligand_pdbqt_input"]
+                    ),
+                    dict(params, **self.sites[receptor_ref][site]),
+                    self.site_directory(self.vina_output_shared, site),
+                )
+            )
+            sites.append(site)
+        refined_results = []
+        for site, output in zip(sites, self.run_dockings(dockings)):
+            if output is None:
+                continue
+            pdbqt, log = output
+            logdata = self.process_vina_output(
+                pdbqt, log, docking_mode(params)
+            )
+            logdata["site"] = site
+            refined_results.append((pdbqt, log, logdata))
+        return refined_results
+
+    def receptor_maps(self, receptor_filename, params):
+        """
+        Return the prefix of the grid maps of a receptor for the search box
+        in params, computing them on first use so that every ligand docked
+        to the same receptor and box reuses them, if reuse_maps is set.
+        Returns None, so that each docking computes its own maps, if
+        reuse_maps is not set or the maps can not be written.
+        Loading the maps takes about as long as computing them, and
+        --force_even_voxels can change the results, so maps are not reused
+        by default.
+        param: receptor_filename - the receptor PDBQT filename
+        """
+        if not int(params.get("reuse_maps", 0) or 0):
+            return None
+        search = search_parameters(params)
+        box = tuple(
+            search[name]
+            for name in SEARCH_PARAMETERS
+            if name.startswith(("center_", "size_"))
+        )
+        key = (receptor_filename, box, scoring_function(params))
+        with self._grid_maps_lock:
+            if key in self.grid_maps:
+                return self.grid_maps[key]
+            version = vina_version()
+            if version is None or version < (1, 2):
+                # --write_maps is new in vina 1.2.
+                logging.warning(
+                    "Computing grid maps for every ligand instead: the vina "
+                    "command can not write them."
+                )
+                self.grid_maps[key] = None
+                return None
+            directory = os.path.join(self.shared_folder, "vina_maps")
+            os.makedirs(directory, exist_ok=True)
+            prefix = os.path.join(
+                directory,
+                f"{os.path.split(receptor_filename)[1]}."
+                f"{hash_key(*map(str, key[1:]))[:16]}",
+            )
+            timeout = params.get("vina_timeout") or None
+            try:
+                with self.instrumentation.measure("receptor_maps"):
+                    receptor_maps(
+                        receptor_filename,
+                        prefix,
+                        params,
+                        timeout=float(timeout) if timeout else None,
+                    )
+            except (subprocess.TimeoutExpired, VinaError, OSError) as exc:
+                logging.warning(
+                    f"Computing grid maps for every ligand instead: {exc}"
+                )
+                prefix = None
+            self.grid_maps[key] = prefix
+            return prefix
+
+    def record_failure(self, ligand_filename, stage, error, attempts=1):
+        """
+        Record that a ligand could not be processed so that it is listed in
+        the report.
+        """
+        self.failures.append(
+            self.ligand_record(
+                ligand_filename, attempts=attempts, error=error, stage=stage
+            )
+        )
+
+    def run_vina(
+        self,
+        receptor_filename,
+        ligand_filename,
+        params,
+        cpu=None,
+        working_directory=None,
+    ):
+        """
+        Run AutoDock vina for a pair of receptor and ligand, limited to
+        vina_timeout seconds. Failed runs are retried vina_retries times,
+        but runs which time out are not, since a rerun with the same seed
+        and parameters would time out again. If the docking fails the
+        failure is recorded and None is returned.
+        param: receptor_filename - the receptor PDBQT filename
+        param: ligand_filename - the ligand PDBQT filename
+        param: working_directory - where vina writes its output, by default
+            self.vina_output_shared
+        """
+        working_directory = working_directory or self.vina_output_shared
+        engine = docking_engine(params.get("engine"))
+        params = engine.parameters(params)
+        key = checkpoint_key(
+            receptor_filename, ligand_filename, working_directory, params
+        )
+        completed = self.manifest.get(key)
+        if completed:
+            logging.info(f"Skipping completed docking of {ligand_filename}.")
+            return tuple(completed["paths"])
+        timeout = params.get("vina_timeout") or None
+        maps = None
+        if "grid_maps" in engine.capabilities:
+            maps = self.receptor_maps(receptor_filename, params)
+        attempts = 1 + int(params.get("vina_retries", 1) or 0)
+        for attempt in range(1, attempts + 1):
+            try:
+                with self.instrumentation.measure(
+                    "run_vina", os.path.split(ligand_filename)[1]
+                ) as record:
+                    output = (self.spool_vina if self.spool else engine.dock)(
+                        receptor_filename,
+                        ligand_filename,
+                        working_directory,
+                        params,
+                        cpu=cpu,
+                        cache=self.result_cache,
+                        timeout=float(timeout) if timeout else None,
+                        maps=maps,
+                    )
+            except subprocess.TimeoutExpired:
+                self.record_failure(
+                    ligand_filename,
+                    "run_vina",
+                    f"vina did not finish within {timeout} seconds",
+                    attempt,
+                )
+                return None
+            except (VinaError, OSError) as exc:
+                error = str(exc)
+            else:
+                self.manifest.record(key, *output)
+                seconds = record.get("vina_seconds")
+                if seconds is None and record["child_cpu_seconds"]:
+                    # vina ran rather than the result being cached
+                    seconds = record["wall_seconds"]
+                # The cost model is of dockings with a search.
+                if seconds and docking_mode(params) == "dock":
+                    self.observe_runtime(ligand_filename, params, cpu, seconds)
+                return output
+            logging.warning(
+                f"Attempt {attempt} of {attempts} to dock {ligand_filename} "
+                f"failed: {error}"
+            )
+        self.record_failure(ligand_filename, "run_vina", error, attempts)
+        return None
+
+    def run_vinas(
+        self,
+        receptor_filename,
+        ligand_filenames,
+        params,
+        working_directory=None,
+    ):
+        """
+        Run AutoDock vina for each pair of receptor and ligand, like
+        run_dockings, and return the results in input order. Ligands which
+        failed to dock are left out.
         param: receptor_filename - the receptor PDBQT filename
         param: ligand_filenames - a list of ligand PDBQT filenames
+        param: working_directory - where vina writes its output, by default
+            self.vina_output_shared
         """
-        return [
-            run_vina(
-                receptor_filename,
-                ligand_filename,
-                self.vina_output_shared,
-                params,
+        outputs = self.run_dockings(
+            [
+                (receptor_filename, ligand_filename, params, working_directory)
+                for ligand_filename in ligand_filenames
+            ]
+        )
+        return [output for output in outputs if output is not None]
+
+    def run_dockings(self, dockings):
+        """
+        Run AutoDock vina for each of a list of dockings, tuples of the
+        receptor PDBQT filename, the ligand PDBQT filename, the params and
+        the working directory. The dockings are run concurrently, those the
+        cost model predicts to take longest first, and the results are
+        returned in input order, None for each docking which failed.
+        """
+        if not dockings:
+            return []
+        workers, cpu = self.docking_cpus(len(dockings), dockings[0][2])
+        logging.info(
+            f"Running {len(dockings)} dockings with {workers} concurrent "
+            f"vina processes using {cpu} cpus each."
+        )
+        # The costs of the dockings which share their params are predicted
+        # together.
+        groups = {}
+        for index, (_, _, params, _) in enumerate(dockings):
+            groups.setdefault(id(params), []).append(index)
+        costs = np.zeros(len(dockings))
+        for indices in groups.values():
+            costs[indices] = self.cost_model.predict(
+                docking_features(
+                    [dockings[index][1] for index in indices],
+                    dockings[indices[0]][2],
+                    cpu,
+                )
             )
-            for ligand_filename in ligand_filenames
-        ]
+        if self.spool:
+            workers = SPOOL_TASKS_IN_FLIGHT
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {}
+            for index in np.argsort(-costs, kind="stable"):
+                receptor, ligand, params, directory = dockings[index]
+                futures[index] = executor.submit(
+                    self.run_vina,
+                    receptor,
+                    ligand,
+                    params,
+                    cpu=cpu,
+                    working_directory=directory,
+                )
+            return [futures[index].result() for index in range(len(dockings))]
+
+    def search_box_parameters(self, params, receptor):
+        """
+        Return params with the search box computed from the receptor
+        geometry if box_mode asks for it, padded by box_margin Angstrom.
+        param: receptor - the local copy of a receptor object in PDB format
+        """
+        if (params.get("box_mode") or "manual") in ("manual", "pockets"):
+            return params
+        atoms = read_pdb_atoms(receptor)
+        box = search_box(
+            atoms["coordinates"][search_box_mask(atoms, params)],
+            float(params.get("box_margin") or 4.0),
+        )
+        logging.info(f"Using the {params['box_mode']} search box {box}.")
+        return dict(params, **box)
+
+    def site_directory(self, working_directory, site):
+        """
+        Return the directory for the vina output of a docking site, a
+        subdirectory of working_directory for named sites.
+        """
+        if not site:
+            return working_directory
+        directory = os.path.join(working_directory, site)
+        os.makedirs(directory, exist_ok=True)
+        return directory
+
+    def split_ligand(self, ligand):
+        """
+        Split a compound set SDF file into one SDF file per molecule and
+        yield their paths.
+        param: ligand - the local copy of a compound set
+        """
+        for path, title in split_sdf(ligand):
+            self.ligand_names[os.path.split(path)[1]] = title
+            yield path
+
+    def spool_vina(
+        self,
+        receptor,
+        ligand,
+        working_directory,
+        params,
+        cpu=None,
+        cache=None,
+        timeout=None,
+        maps=None,
+    ):
+        """
+        Dock a ligand like run_vina, on a worker of the spool. The usage of
+        the worker is added to the current measurement, with the runtime of
+        vina as vina_seconds. Raises VinaError if the task is not done within
+        params["spool_timeout"] seconds, or while no local worker is left.
+        """
+        task_id = self.spool.submit(
+            dict(
+                receptor=receptor,
+                ligand=ligand,
+                working_directory=working_directory,
+                params=params,
+                cpu=cpu,
+                timeout=timeout,
+                maps=maps,
+                cache_dir=cache.path if cache is not None else None,
+                cache_max_bytes=cache.max_bytes if cache is not None else None,
+            )
+        )
+        alive = self.spool_workers_alive if self.spool_workers else None
+        try:
+            result = self.spool.wait(
+                task_id, timeout=params.get("spool_timeout"), alive=alive
+            )
+        except SpoolError as exc:
+            raise VinaError(str(exc))
+        usage = result["usage"]
+        record = add_child_usage(**usage)
+        ran = usage.get("child_cpu_seconds") or "vina_seconds" in usage
+        if record is not None and ran:
+            record["vina_seconds"] = usage.get(
+                "vina_seconds", usage.get("wall_seconds", 0.0)
+            )
+        if result.get("timed_out"):
+            raise subprocess.TimeoutExpired("vina", timeout)
+        if "error" in result:
+            raise VinaError(result["error"])
+        return tuple(result["output"])
+
+    def start_spool(self, params):
+        """
+        Distribute the dockings through a spool at params["spool_dir"], if
+        given, to workers started with python -m kb_ad_vina.worker on any
+        host which mounts it and the scratch directory at the same paths.
+        spool_workers workers are started on this host, by default as many
+        as vina processes would run here.
+        """
+        spool_dir = params.get("spool_dir")
+        if not spool_dir:
+            return
+        self.spool = Spool(spool_dir)
+        self.spool.start()
+        count = params.get("spool_workers")
+        if count is None:
+            count, _ = allocate_cpus(
+                available_cpus(),
+                search_threads(params),
+                params.get("max_cpus"),
+            )
+        # The workers idle until the receptors are prepared and exit once
+        # stop_spool stops the spool.
+        self.spool_workers = start_workers(spool_dir, int(count))
+        logging.info(
+            f"Distributing dockings through {spool_dir} with "
+            f"{len(self.spool_workers)} local workers."
+        )
+
+    def spool_workers_alive(self):
+        """Return whether any local worker of the spool is running."""
+        return any(worker.poll() is None for worker in self.spool_workers)
+
+    def stop_spool(self):
+        """Stop the workers of the spool and wait for the local ones."""
+        if self.spool is None:
+            return
+        self.spool.stop()
+        for worker in self.spool_workers:
+            worker.wait()
+        self.spool = None
+        self.spool_workers = []
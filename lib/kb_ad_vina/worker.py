@@ -0,0 +1,111 @@
+"""
+A worker which docks the tasks of a Spool. Start any number of them, on this
+host or any other which mounts the spool and the job's scratch directory at
+the same paths:
+
+    python -m kb_ad_vina.worker /kb/module/work/tmp/spool
+
+A worker exits when the coordinator stops the spool and no task is pending,
+or after --idle-timeout seconds without a task.
+"""
+import argparse
+import logging
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from .cache import DiskCache
+from .instrumentation import Instrumentation
+from .spool import Spool
+from .utils import VinaError, docking_engine
+
+
+def execute(task):
+    """
+    Dock the ligand of a task and return the result: the paths of the
+    output under "output", or the "error" and whether it "timed_out", with
+    the resource "usage" of vina.
+    """
+    instrumentation = Instrumentation()
+    result = {}
+    record = {}
+    try:
+        with instrumentation.measure("run_vina", task["ligand"]) as record:
+            cache = None
+            if task.get("cache_dir"):
+                cache = DiskCache(task["cache_dir"], task["cache_max_bytes"])
+            engine = docking_engine(task["params"].get("engine"))
+            result["output"] = engine.dock(
+                task["receptor"],
+                task["ligand"],
+                task["working_directory"],
+                task["params"],
+                cpu=task.get("cpu"),
+                cache=cache,
+                timeout=task.get("timeout"),
+                maps=task.get("maps"),
+            )
+    except subprocess.TimeoutExpired:
+        result.update(error="timed out", timed_out=True)
+    except (VinaError, OSError) as exc:
+        result["error"] = str(exc)
+    except Exception as exc:
+        # Report any other failure to the coordinator, which would
+        # otherwise wait for the task forever.
+        logging.exception(f"Task for {task['ligand']} failed")
+        result["error"] = f"{type(exc).__name__}: {exc}"
+    result["usage"] = record
+    return result
+
+
+def work(spool, poll=0.5, idle_timeout=None):
+    """
+    Claim and execute the tasks of a spool until it is stopped and no task
+    is pending, or until idle_timeout seconds pass without a task.
+    Returns the number of tasks executed.
+    """
+    executed = 0
+    idle_since = time.monotonic()
+    while True:
+        claimed = spool.claim()
+        if claimed is None:
+            idle = time.monotonic() - idle_since
+            if spool.stopped() or (idle_timeout and idle > idle_timeout):
+                return executed
+            time.sleep(poll)
+            continue
+        task_id, task = claimed
+        working = threading.Event()
+
+        def refresh():
+            while not working.wait(spool.lease / 3):
+                spool.refresh(task_id)
+
+        refresher = threading.Thread(target=refresh, daemon=True)
+        refresher.start()
+        try:
+            result = execute(task)
+        finally:
+            working.set()
+            refresher.join()
+        spool.complete(task_id, result)
+        executed += 1
+        idle_since = time.monotonic()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("spool", help="the spool directory")
+    parser.add_argument("--poll", type=float, default=0.5)
+    parser.add_argument("--idle-timeout", type=float, default=None)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    executed = work(Spool(args.spool), args.poll, args.idle_timeout)
+    logging.info(f"Worker {os.getpid()} executed {executed} tasks.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+"""
+Compare the in-process receptor PDBQT conversion with the former obabel and
+grep subprocess pair.
+
+Usage: PYTHONPATH=lib python scripts/benchmark_receptor_pdbqt.py [receptor.pdb]
+"""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from kb_ad_vina.utils import receptor_as_pdbqt
+
+
+def legacy_receptor_as_pdbqt(receptor):
+    out_filename = f"{receptor}qt"
+    subprocess.run(
+        f"obabel -i pdb {receptor} -o pdbqt -O {receptor}.obabel.pdbqt",
+        shell=True,
+        capture_output=True,
+    )
+    subprocess.run(
+        f'grep -e "^\\(ATOM\\|TER\\)" {receptor}.obabel.pdbqt > {out_filename}',
+        shell=True,
+        capture_output=True,
+    )
+    return out_filename
+
+
+def timed(function, receptor, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out_filename = function(receptor)
+        times.append(time.perf_counter() - start)
+    with open(out_filename) as f:
+        return min(times), f.read()
+
+
+def main():
+    source = sys.argv[1] if len(sys.argv) > 1 else "test/data/6wzu.pdb"
+    repeat = int(os.environ.get("REPEAT", 3))
+    with tempfile.TemporaryDirectory() as tmp:
+        receptor = shutil.copy(source, tmp)
+        legacy_time, legacy = timed(legacy_receptor_as_pdbqt, receptor, repeat)
+        current_time, current = timed(receptor_as_pdbqt, receptor, repeat)
+    print(f"obabel + grep: {legacy_time:.3f}s")
+    print(f"in-process:    {current_time:.3f}s")
+    print(f"identical output: {legacy == current}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+"""
+Benchmark ADVinaApp.do_analysis end to end against the local stand-ins for
+the KBase services in fakes.py. Requires vina and obabel, so run it in the
+module's container:
+
+    PYTHONPATH=lib python test/benchmark/benchmark.py \
+        --ligand-sets 4 --ligands-per-set 8 --exhaustiveness 2
+
+The results are printed as JSON and compared with the baseline of the same
+workload in baseline.json. Throughput below the baseline, or a stage
+latency or peak memory above it, by more than the tolerance fails the run.
+With --engines the same workload is run with each docking engine:
+
+    PYTHONPATH=lib python test/benchmark/benchmark.py \
+        --engines cli python vinardo
+
+--save-baseline stores the results in place of the baselines of the same
+workloads. Record the baseline in the module's image, so that it has the
+cpus and the versions of vina and Open Babel the app runs with:
+
+    make benchmark BENCHMARK_ARGS=--save-baseline
+
+Results are only compared with a baseline recorded on the same host.
+"""
+import argparse
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+
+from kb_ad_vina.utils import (
+    ADVinaApp,
+    DOCKING_ENGINES,
+    available_cpus,
+    docking_engine,
+    openbabel_version,
+)
+
+from fakes import fake_clients
+
+BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+# Stage latencies may exceed the baseline by this many seconds besides the
+# tolerance, so that the noise of stages taking milliseconds is ignored.
+LATENCY_SLACK_SECONDS = 0.05
+# The search box around the binding site of 6wzu used by the tests.
+SEARCH_BOX = dict(
+    center_x=-7,
+    center_y=78,
+    center_z=38.6,
+    size_x=34,
+    size_y=30,
+    size_z=22,
+)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--ligand-sets", type=int, default=2)
+    parser.add_argument("--ligands-per-set", type=int, default=4)
+    parser.add_argument("--exhaustiveness", type=int, default=2)
+    parser.add_argument("--num-modes", type=int, default=9)
+    parser.add_argument("--max-cpus", type=int, default=None)
+    parser.add_argument("--cache-dir", default=None)
+    parser.add_argument(
+        "--engines",
+        nargs="+",
+        default=["python"],
+        choices=sorted(DOCKING_ENGINES),
+        help="the docking engines to run the workload with",
+    )
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="allowed relative regression of throughput and latency",
+    )
+    parser.add_argument(
+        "--memory-tolerance",
+        type=float,
+        default=0.2,
+        help="allowed relative increase of peak memory",
+    )
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="store the results as the baseline of their workloads",
+    )
+    return parser.parse_args(argv)
+
+
+def run(args, engine="cli"):
+    """Run one benchmark with a docking engine and return its results."""
+    Workspace, clients = fake_clients(args.ligands_per_set)
+    scratch = tempfile.mkdtemp(prefix="kb_ad_vina_benchmark_")
+    config = dict(
+        cache_dir=args.cache_dir,
+        callback_url=None,
+        clients=clients,
+        shared_folder=scratch,
+        ws_url=None,
+        Workspace=Workspace,
+    )
+    params = dict(
+        SEARCH_BOX,
+        exhaustiveness=args.exhaustiveness,
+        ligand_refs=[f"1/{index + 2}/1" for index in range(args.ligand_sets)],
+        max_cpus=args.max_cpus,
+        num_modes=args.num_modes,
+        receptor_ref="1/1/1",
+        workspace_name="benchmark",
+        engine=engine,
+    )
+    app = ADVinaApp({"token": None}, config)
+    start = time.perf_counter()
+    app.do_analysis(params)
+    elapsed = time.perf_counter() - start
+    ligands = args.ligand_sets * args.ligands_per_set
+    stages = app.instrumentation.summary()
+    return dict(
+        workload=dict(
+            ligand_sets=args.ligand_sets,
+            ligands_per_set=args.ligands_per_set,
+            exhaustiveness=args.exhaustiveness,
+            num_modes=args.num_modes,
+            max_cpus=args.max_cpus,
+            engine=engine,
+        ),
+        engine=docking_engine(engine).profile(),
+        host=dict(cpus=available_cpus(), versions=versions()),
+        ligands=ligands,
+        wall_seconds=round(elapsed, 3),
+        ligands_per_minute=round(60 * ligands / elapsed, 3),
+        stage_latency_seconds={
+            stage: round(totals["wall_seconds"] / totals["count"], 4)
+            for stage, totals in stages.items()
+        },
+        peak_rss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        peak_child_rss_kb=max(
+            (totals["child_peak_rss_kb"] for totals in stages.values()),
+            default=0,
+        ),
+    )
+
+
+def versions():
+    """Return the versions of the docking software."""
+    try:
+        from vina import __version__ as vina
+    except ImportError:
+        vina = None
+    return dict(openbabel=openbabel_version(), vina=vina)
+
+
+def compare(results, baseline, tolerance, memory_tolerance=0.2):
+    """
+    Return a list of regressions of results compared with a baseline of the
+    same workload: in throughput, in the latency of each stage and in peak
+    memory.
+    """
+    if baseline["workload"] != results["workload"]:
+        return []
+    regressions = []
+    floor = baseline["ligands_per_minute"] * (1 - tolerance)
+    if results["ligands_per_minute"] < floor:
+        regressions.append(
+            f"throughput {results['ligands_per_minute']} ligands/min is "
+            f"below the baseline {baseline['ligands_per_minute']}"
+        )
+    latencies = results["stage_latency_seconds"]
+    for stage, latency in baseline["stage_latency_seconds"].items():
+        ceiling = latency * (1 + tolerance) + LATENCY_SLACK_SECONDS
+        if latencies.get(stage, 0) > ceiling:
+            regressions.append(
+                f"{stage} latency {latencies[stage]} s is above the "
+                f"baseline {latency} s"
+            )
+    for field in ("peak_rss_kb", "peak_child_rss_kb"):
+        if results[field] > baseline[field] * (1 + memory_tolerance):
+            regressions.append(
+                f"{field} {results[field]} is above the baseline "
+                f"{baseline[field]}"
+            )
+    return regressions
+
+
+def save_baseline(runs, path):
+    """Store runs in place of the baselines of the same workloads."""
+    baselines = []
+    if os.path.exists(path):
+        with open(path) as f:
+            baselines = json.load(f)
+    if isinstance(baselines, dict):
+        baselines = [baselines]
+    workloads = [results["workload"] for results in runs]
+    baselines = [
+        baseline
+        for baseline in baselines
+        if baseline["workload"] not in workloads
+    ]
+    with open(path, "w") as f:
+        json.dump(baselines + runs, f, indent=1)
+        f.write("\n")
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    runs = [run(args, engine) for engine in args.engines]
+    print(json.dumps(runs[0] if len(runs) == 1 else runs, indent=1))
+    if args.save_baseline:
+        save_baseline(runs, args.baseline)
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}, use --save-baseline.")
+        return 0
+    with open(args.baseline) as f:
+        baselines = json.load(f)
+    if isinstance(baselines, dict):
+        baselines = [baselines]
+    regressions = []
+    for results in runs:
+        # Each run is compared with the baseline of the same workload.
+        matching = [
+            baseline
+            for baseline in baselines
+            if baseline["workload"] == results["workload"]
+        ]
+        if not matching:
+            print(
+                f"No baseline was recorded for the workload of the "
+                f"{results['workload']['engine']} engine."
+            )
+        for baseline in matching:
+            if baseline.get("host") != results["host"]:
+                # Throughput and memory on other cpus or versions of the
+                # docking software say nothing about a regression.
+                print(
+                    f"Not comparing with the baseline recorded on another "
+                    f"host: {baseline.get('host')}."
+                )
+                continue
+            regressions += [
+                f"{results['workload']['engine']} engine: {regression}"
+                for regression in compare(
+                    results, baseline, args.tolerance, args.memory_tolerance
+                )
+            ]
+    for regression in regressions:
+        print(f"REGRESSION: {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,116 @@
+"""
+Local stand-ins for the KBase service clients used by ADVinaApp. They serve
+the files in test/data so that the docking pipeline can run without
+network access.
+"""
+import itertools
+import os
+import shutil
+import tempfile
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data")
+RECEPTOR = "6wzu.pdb"
+LIGANDS = (
+    "Structure2D_CID_49846579.sdf",
+    "Structure2D_CID_139024764.sdf",
+)
+
+
+class FakeWorkspace:
+    """Serves CompoundSet objects of a fixed number of compounds."""
+
+    ligands_per_set = 1
+
+    def __init__(self, url=None, token=None):
+        self.url = url
+
+    def get_objects2(self, params):
+        return {
+            "data": [
+                {
+                    "path": [obj["ref"]],
+                    "data": {
+                        "name": f"CompoundSet {obj['ref']}",
+                        "compounds": [
+                            {"id": f"compound {index}"}
+                            for index in range(self.ligands_per_set)
+                        ],
+                    },
+                }
+                for obj in params["objects"]
+            ]
+        }
+
+
+class FakeCompoundSetUtils:
+    """Exports each CompoundSet as an SDF built from the test ligands."""
+
+    ligands_per_set = 1
+
+    def __init__(self, url=None, *args, **kwargs):
+        self.url = url
+
+    def compound_set_to_file(self, params):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "compound_set.sdf")
+        molecules = itertools.islice(
+            itertools.cycle(LIGANDS), self.ligands_per_set
+        )
+        with open(path, "w") as out:
+            for molecule in molecules:
+                with open(os.path.join(DATA_DIR, molecule)) as f:
+                    out.write(f.read())
+        return {"file_path": path}
+
+
+class FakeDataFileUtil:
+    """Treats shock ids as the names of files in test/data."""
+
+    def __init__(self, url=None, *args, **kwargs):
+        self.url = url
+
+    def shock_to_file(self, params):
+        shutil.copyfile(
+            os.path.join(DATA_DIR, params["shock_id"]), params["file_path"]
+        )
+        return {"file_path": params["file_path"]}
+
+
+class FakeProteinStructureUtils:
+    """Exports every structure as the test receptor."""
+
+    def __init__(self, url=None, *args, **kwargs):
+        self.url = url
+
+    def export_pdb_structures(self, params):
+        return {"shock_id": RECEPTOR}
+
+
+class FakeKBaseReport:
+    """Accepts reports without saving them."""
+
+    def __init__(self, url=None, *args, **kwargs):
+        self.url = url
+        self.reports = []
+
+    def create_extended_report(self, params):
+        self.reports.append(params)
+        return {
+            "name": params.get("report_object_name"),
+            "ref": "1/1/1",
+        }
+
+
+def fake_clients(ligands_per_set):
+    """
+    Return the Workspace class and the clients dictionary expected in an
+    ADVinaApp config, serving CompoundSets of ligands_per_set molecules.
+    """
+    FakeWorkspace.ligands_per_set = ligands_per_set
+    FakeCompoundSetUtils.ligands_per_set = ligands_per_set
+    return FakeWorkspace, dict(
+        CompoundSetUtils=FakeCompoundSetUtils,
+        DataFileUtil=FakeDataFileUtil,
+        KBaseReport=FakeKBaseReport,
+        ProteinStructureUtils=FakeProteinStructureUtils,
+    )
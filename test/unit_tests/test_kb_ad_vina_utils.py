@@ -1,18 +1,61 @@
+import json
 import logging
 import math
 import os
 import re
 import subprocess
+import time
 
+import numpy as np
 import pytest
 
+from benchmark.fakes import fake_clients
+
+import kb_ad_vina.embedded
+import kb_ad_vina.utils
+from kb_ad_vina.cache import DiskCache, PackCache
+from kb_ad_vina.checkpoint import CheckpointManifest
+from kb_ad_vina.costmodel import CostModel
+from kb_ad_vina.instrumentation import Instrumentation, communicate
+from kb_ad_vina.pipeline import Pipeline, Stage
+from kb_ad_vina.pockets import detect_pockets
+from kb_ad_vina.spool import Spool, SpoolError, start_workers
 from kb_ad_vina.utils import (
+    ADVinaApp,
+    affinity_matrix,
+    allocate_cpus,
+    checkpoint_key,
+    ConversionError,
+    DOCKING_ENGINES,
+    docking_cache_key,
+    docking_engine,
     get_affinity_from_vina_log,
+    ligand_cache_key,
+    ligand_descriptors,
+    ligand_filter_reasons,
     ligand_as_pdbqt,
+    parse_pdbqt_poses,
+    parse_vina_log,
+    parse_vina_output,
+    read_pdb_atoms,
     receptor_as_pdbqt,
+    receptor_cache_key,
+    receptor_maps,
+    receptor_references,
     run_vina,
+    run_vina_embedded,
+    screening_parameters,
+    search_box,
+    search_box_mask,
+    search_threads,
+    vina_output_paths,
+    vina_version,
+    select_top_ligands,
+    split_sdf,
     upa_filename_pattern,
+    VinaError,
 )
+from kb_ad_vina.worker import execute
 
 
 def clean():
@@ -46,6 +89,25 @@ def receptor():
     return "6wzu.pdb"
 
 
+def make_app(tmp_path, scratch="scratch"):
+    """Return an ADVinaApp with fake clients and a cache in tmp_path."""
+    Workspace, clients = fake_clients(2)
+    config = dict(
+        cache_dir=str(tmp_path / "cache"),
+        callback_url=None,
+        clients=clients,
+        shared_folder=str(tmp_path / scratch),
+        ws_url=None,
+        Workspace=Workspace,
+    )
+    return ADVinaApp({"token": None}, config)
+
+
+@pytest.fixture
+def app(tmp_path):
+    return make_app(tmp_path)
+
+
 def test_01_pdb_to_pdbqt(receptor):
     receptor_converted = receptor_as_pdbqt(receptor)
     with open(receptor_converted) as f:
@@ -98,3 +160,838 @@ def test_03_vina(receptor, ligands):
                 float(stdout.decode("utf-8", "ignore")[:-1]),
                 abs_tol=EPSILON,
             )
+
+
+def test_04_allocate_cpus():
+    # Many small tasks: one vina process per core.
+    assert allocate_cpus(500, exhaustiveness=8, total_cpus=32) == (32, 1)
+    # Few tasks: spare cores become vina threads, bounded by exhaustiveness.
+    assert allocate_cpus(4, exhaustiveness=8, total_cpus=32) == (4, 8)
+    assert allocate_cpus(4, exhaustiveness=4, total_cpus=6) == (4, 1)
+    assert allocate_cpus(1, exhaustiveness=8, total_cpus=1) == (1, 1)
+
+
+def test_05_result_cache(tmp_path, receptor, ligands):
+    params = {"center_x": "-7", "exhaustiveness": 8}
+    key = docking_cache_key(receptor, ligands[0], params)
+    # Equivalent parameters share a key, different inputs do not.
+    assert key == docking_cache_key(receptor, ligands[0], {"center_x": -7.0})
+    assert key != docking_cache_key(receptor, ligands[1], params)
+    assert key != docking_cache_key(receptor, ligands[0], {"seed": 1})
+    cache = DiskCache(str(tmp_path / "cache"), max_bytes=1024)
+    assert cache.get(key) is None
+    small = tmp_path / "small.log"
+    small.write_text("x" * 600)
+    cache.put("a", {"log": str(small)})
+    os.utime(tmp_path / "cache" / "a", (0, 0))
+    cache.put(key, {"log": str(small)})
+    # The least recently used entry is evicted to stay under max_bytes.
+    assert cache.get("a") is None
+    with open(cache.get(key)["log"]) as f:
+        assert f.read() == "x" * 600
+    # The directory is scanned again only once the total is over budget.
+    scans = []
+    evict = cache.evict
+    cache.evict = lambda: scans.append(1) or evict()
+    tiny = tmp_path / "tiny.log"
+    tiny.write_text("x" * 100)
+    cache.put("b", {"log": str(tiny)})
+    assert not scans
+    cache.put("c", {"log": str(small)})
+    assert scans and cache.get(key) is None and cache.get("c")
+
+
+def test_06_split_sdf(tmp_path, ligands):
+    compound_set = tmp_path / "_w1o2v3_.sdf"
+    with open(compound_set, "w") as out:
+        for ligand in ligands:
+            with open(ligand) as f:
+                out.write(f.read())
+    molecules = list(split_sdf(str(compound_set)))
+    assert [os.path.split(path)[1] for path, _ in molecules] == [
+        "_w1o2v3_m0.sdf",
+        "_w1o2v3_m1.sdf",
+    ]
+    assert [title for _, title in molecules] == ["49846579", "139024764"]
+    for (path, _), ligand in zip(molecules, ligands):
+        with open(path) as f, open(ligand) as g:
+            assert f.read() == g.read()
+
+
+def test_07_pipeline():
+    pipeline = Pipeline(
+        [
+            Stage("split", lambda n: list(range(n)), workers=2, fan_out=True),
+            Stage("square", lambda n: n * n, workers=3, maxsize=1),
+        ]
+    )
+    # Results keep the input order even with several workers per stage.
+    assert pipeline.run([3, 0, 2]) == [0, 1, 4, 0, 1]
+    stats = {stage["name"]: stage for stage in pipeline.stats()}
+    assert stats["split"]["processed"] == 3
+    assert stats["square"]["processed"] == 5
+    assert stats["square"]["max_queue_depth"] <= 1
+
+    def fail(n):
+        raise ValueError(n)
+
+    with pytest.raises(ValueError):
+        Pipeline([Stage("fail", fail, workers=2)]).run(range(5))
+    # A batch stage is called with the items waiting on its queue.
+    batches = []
+
+    def repeat(values):
+        batches.append(len(values))
+        return [[value] * value for value in values]
+
+    pipeline = Pipeline([Stage("repeat", repeat, fan_out=True, batch_size=3)])
+    assert pipeline.run([1, 2, 0, 3]) == [1, 2, 2, 3, 3, 3]
+    assert sum(batches) == 4 and max(batches) <= 3
+    assert pipeline.stats()[0]["processed"] == 4
+    # A stage with a priority takes the waiting items lowest first.
+    stage = Stage("dock", None, maxsize=10, priority=lambda cost: -cost)
+    for index, cost in enumerate([1, 5, 3]):
+        stage.put(((index,), cost))
+    stage.close()
+    assert [stage.get_batch()[0][0][1] for _ in range(3)] == [5, 3, 1]
+    assert stage.get_batch() == ([], True)
+
+
+VINA_LOG = """\
+Reading input ... done.
+Setting up the scoring function ... done.
+Using random seed: 0
+Performing search ... done.
+Refining results ... done.
+
+mode |   affinity | dist from best mode
+     | (kcal/mol) | rmsd l.b.| rmsd u.b.
+-----+------------+----------+----------
+   1         -8.1      0.000      0.000
+   2         -7.6      1.892      2.744
+   3         -7.2     22.710     25.033
+Writing output ... done.
+"""
+
+VINA_PDBQT = """\
+MODEL 1
+REMARK VINA RESULT:      -8.1      0.000      0.000
+ATOM      1  C   UNL     1      -6.021  77.340  38.120  0.00  0.00    +0.000 C
+ATOM      2  N   UNL     1      -5.011  76.500  37.002  0.00  0.00    -0.300 NA
+ENDMDL
+MODEL 2
+REMARK VINA RESULT:      -7.6      1.892      2.744
+ATOM      1  C   UNL     1      -7.021  78.340  39.120  0.00  0.00    +0.000 C
+ATOM      2  N   UNL     1      -6.011  77.500  38.002  0.00  0.00    -0.300 NA
+ENDMDL
+"""
+
+
+def test_08_parse_vina_output():
+    modes = parse_vina_log(VINA_LOG)
+    assert [mode["mode"] for mode in modes] == [1, 2, 3]
+    assert modes[2] == dict(
+        mode=3, affinity=-7.2, rmsd_lb=22.71, rmsd_ub=25.033
+    )
+    # The best affinity no longer depends on the length of the header.
+    assert get_affinity_from_vina_log(VINA_LOG) == -8.1
+    coordinates, affinities = parse_pdbqt_poses(VINA_PDBQT)
+    assert coordinates.shape == (2, 2, 3)
+    assert coordinates[1, 0].tolist() == pytest.approx([-7.021, 78.34, 39.12])
+    assert affinities.tolist() == pytest.approx([-8.1, -7.6])
+
+
+def test_09_instrumentation(tmp_path):
+    instrumentation = Instrumentation()
+    with instrumentation.measure("outer"):
+        with instrumentation.measure("child", "ligand"):
+            with subprocess.Popen(
+                "head -c 100000 /dev/zero",
+                shell=True,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+            ) as proc:
+                stdout, _ = communicate(proc)
+    assert len(stdout) == 100000
+    assert proc.returncode == 0
+    child, outer = instrumentation.records
+    assert child["ligand"] == "ligand"
+    assert child["child_bytes_written"] >= 100000
+    assert child["child_peak_rss_kb"] > 0
+    assert child["wall_seconds"] > 0
+    # Child process usage counts towards the enclosing measurement too.
+    assert outer["child_bytes_written"] == child["child_bytes_written"]
+    summary = instrumentation.summary()
+    assert summary["child"]["count"] == 1
+    path = instrumentation.write(str(tmp_path / "instrumentation.json"))
+    with open(path) as f:
+        assert set(json.load(f)) == {"stages", "records"}
+
+
+def test_10_screening():
+    assert screening_parameters({"exhaustiveness": 8}) is None
+    prescreen = screening_parameters({"exhaustiveness": 8, "screen_top_k": 2})
+    assert prescreen["exhaustiveness"] == 1
+    assert prescreen["num_modes"] == 1
+    affinities = [-7.0, None, -9.5, -8.1, -6.2]
+    assert select_top_ligands(affinities, top_k=2) == [2, 3]
+    assert select_top_ligands(affinities, top_percent=20) == [2]
+    assert select_top_ligands(affinities, top_k=10, top_percent=60) == [
+        0,
+        2,
+        3,
+    ]
+
+
+def test_11_checkpoint_manifest(tmp_path):
+    path = str(tmp_path / "manifest.jsonl")
+    output = tmp_path / "out.pdbqt"
+    output.write_text("MODEL 1")
+    manifest = CheckpointManifest(path)
+    assert manifest.get("a") is None
+    manifest.record("a", str(output))
+    manifest.record("b", str(tmp_path / "missing.pdbqt"))
+    # Simulate a crash in the middle of writing a record.
+    with open(path, "a") as f:
+        f.write('{"key": "c", "fi')
+    resumed = CheckpointManifest(path)
+    assert resumed.get("a")["paths"] == [str(output)]
+    # Records whose files are gone or which were cut short do not count.
+    assert resumed.get("b") is None
+    assert resumed.get("c") is None
+    resumed.record("c", str(output))
+    assert CheckpointManifest(path).get("c")["paths"] == [str(output)]
+
+
+# A vina which reports no version and takes too long to dock.
+SLOW_VINA = '[ "$1" = --version ] && exit 0; sleep 30'
+
+
+def fake_vina(tmp_path, monkeypatch, script):
+    """Put an executable named vina running script first on the PATH."""
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    vina = bin_dir / "vina"
+    vina.write_text(f"#!/bin/sh\n{script}\n")
+    vina.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}:{os.environ['PATH']}")
+
+
+def test_12_vina_failures(tmp_path, monkeypatch, receptor, ligands):
+    fake_vina(tmp_path, monkeypatch, "echo 'Parse error' >&2; exit 1")
+    with pytest.raises(VinaError, match="Parse error"):
+        run_vina(receptor, ligands[0], str(tmp_path), {})
+
+
+def test_13_vina_timeout(tmp_path, monkeypatch, receptor, ligands):
+    fake_vina(tmp_path, monkeypatch, SLOW_VINA)
+    with pytest.raises(subprocess.TimeoutExpired):
+        run_vina(receptor, ligands[0], str(tmp_path), {}, timeout=0.5)
+
+
+def test_14_search_box(receptor):
+    atoms = read_pdb_atoms(receptor)
+    zinc = search_box_mask(
+        atoms, {"box_mode": "reference_ligand", "box_reference_ligand": "zn"}
+    )
+    assert zinc.sum() == 1
+    box = search_box(atoms["coordinates"][zinc], margin=4.0)
+    assert (box["size_x"], box["size_y"], box["size_z"]) == (8.0, 8.0, 8.0)
+    residues = search_box_mask(
+        atoms, {"box_mode": "residues", "box_residues": "A:45-50, A:60"}
+    )
+    assert set(atoms["residue"][residues]) == {45, 46, 47, 48, 49, 50, 60}
+    box = search_box(atoms["coordinates"][residues], margin=0)
+    selected = atoms["coordinates"][residues]
+    assert box["size_x"] == pytest.approx(np.ptp(selected[:, 0]), abs=1e-3)
+    with pytest.raises(ValueError):
+        search_box(atoms["coordinates"][:0])
+
+
+def test_15_detect_pockets(receptor):
+    atoms = read_pdb_atoms(receptor)
+    protein = atoms["coordinates"][atoms["record"] == "ATOM"]
+    pockets = detect_pockets(protein)
+    assert pockets
+    scores = [pocket["score"] for pocket in pockets]
+    assert scores == sorted(scores, reverse=True)
+    # Pocket points lie within the receptor but away from its atoms.
+    points = pockets[0]["coordinates"]
+    assert np.all(points >= protein.min(axis=0))
+    assert np.all(points <= protein.max(axis=0))
+    distances = np.linalg.norm(points[:, None] - protein[None], axis=-1)
+    assert distances.min() > 2.0
+    # A single solid block of atoms has no pockets.
+    grid = np.stack(np.meshgrid(*[np.arange(10.0)] * 3), -1).reshape(-1, 3)
+    assert detect_pockets(grid) == []
+
+
+def test_16_receptor_maps(tmp_path, monkeypatch, app, receptor, ligands):
+    # The fake vina writes maps when asked to and fails to dock, showing
+    # its arguments.
+    fake_vina(
+        tmp_path,
+        monkeypatch,
+        'echo "$@" >&2; for arg; do last=$arg; done\n'
+        'case "$*" in *--write_maps*) touch "$last.C_H.map";; *) exit 1;; '
+        "esac",
+    )
+    prefix = str(tmp_path / "maps")
+    assert receptor_maps(receptor, prefix, {}) == prefix
+    assert os.path.exists(f"{prefix}.C_H.map")
+    with pytest.raises(VinaError, match=f"--maps {prefix} "):
+        run_vina(receptor, ligands[0], str(tmp_path), {}, maps=prefix)
+    with pytest.raises(VinaError, match="could not write maps"):
+        receptor_maps(receptor, str(tmp_path / "missing" / "maps"), {})
+    # Maps are reused only on request, and only with a vina command which
+    # reports a version that can write them.
+    assert app.receptor_maps(receptor, {}) is None
+    assert app.receptor_maps(receptor, {"reuse_maps": 1}) is None
+
+
+def test_17_receptor_cache_key(monkeypatch):
+    key = receptor_cache_key("1/2/3")
+    assert key.startswith("_w1o2v3_")
+    assert receptor_cache_key("1/2/3") == key
+    assert receptor_cache_key("1/2/4") != key
+    # Changing the preparation invalidates the cached receptors.
+    monkeypatch.setattr(
+        kb_ad_vina.utils,
+        "RECEPTOR_PREPARATION_VERSION",
+        kb_ad_vina.utils.RECEPTOR_PREPARATION_VERSION + 1,
+    )
+    assert receptor_cache_key("1/2/3") != key
+
+
+def test_18_ligand_cache(tmp_path, app, ligands):
+    key = ligand_cache_key(ligands[0])
+    assert key != ligand_cache_key(ligands[1])
+    # The same molecule under another title shares its conversion.
+    with open(ligands[0]) as f:
+        _, rest = f.read().split("\n", 1)
+    (tmp_path / "renamed.sdf").write_text(f"renamed\n{rest}")
+    assert ligand_cache_key(str(tmp_path / "renamed.sdf")) == key
+    cache = PackCache(str(tmp_path / "ligands.sqlite"), max_bytes=1024)
+    assert cache.get(key) is None
+    cache.put("a", b"x" * 600)
+    cache.put(key, b"y" * 600)
+    # The least recently used entry is evicted to stay under max_bytes.
+    assert cache.get("a") is None
+    assert cache.get(key) == b"y" * 600
+    # The caches of the app share one budget.
+    caches = (app.result_cache, app.receptor_cache, app.ligand_cache)
+    assert sum(cache.max_bytes for cache in caches) <= app.cache_max_bytes
+
+
+def test_19_ligand_filters(tmp_path, ligands):
+    pdbqts = [ligand_as_pdbqt(ligand) for ligand in ligands]
+    descriptors = ligand_descriptors(pdbqts)
+    assert list(descriptors["heavy_atoms"]) == [61, 62]
+    assert list(descriptors["torsions"]) == [13, 13]
+    assert descriptors["molecular_weight"] == pytest.approx(
+        [868.44, 884.44], abs=0.01
+    )
+    assert ligand_filter_reasons(descriptors, {}) == ["", ""]
+    reasons = ligand_filter_reasons(
+        descriptors, {"filter_max_heavy_atoms": 61, "filter_lipinski": 1}
+    )
+    assert reasons[0] == "2 violations of the rule of five"
+    assert reasons[1] == (
+        "62 heavy atoms > 61; 2 violations of the rule of five"
+    )
+    # A V3000 SDF gives the same weight, and a malformed one an error
+    # instead of an exception.
+    v3000 = tmp_path / "v3000.sdf"
+    subprocess.run(
+        ["obabel", "-i", "sdf", ligands[0], "-o", "sdf", "-O", v3000, "-x3"],
+        capture_output=True,
+    )
+    malformed = tmp_path / "malformed.sdf"
+    malformed.write_text("49846579\n\n\nxyz\n")
+    with open(pdbqts[0]) as f:
+        pdbqt = f.read()
+    for sdf in (v3000, malformed):
+        (tmp_path / f"{sdf.name}.pdbqt").write_text(pdbqt)
+    descriptors = ligand_descriptors(
+        [f"{v3000}.pdbqt", f"{malformed}.pdbqt", str(tmp_path / "x.pdbqt")]
+    )
+    assert descriptors["molecular_weight"][0] == pytest.approx(
+        868.44, abs=0.01
+    )
+    assert descriptors["errors"][0] == ""
+    assert "could not read" in descriptors["errors"][1]
+    assert "could not read" in descriptors["errors"][2]
+    with pytest.raises(ConversionError, match="no molecule"):
+        ligand_as_pdbqt(str(malformed))
+
+
+def test_20_cost_model(tmp_path):
+    features = dict(
+        torsions=[2, 12, 2],
+        heavy_atoms=[20, 20, 40],
+        box_volume=[8000, 8000, 8000],
+        exhaustiveness=[8, 8, 8],
+        cpu=[2, 2, 2],
+    )
+    model = CostModel(str(tmp_path / "cost_model.json"))
+    costs = model.predict(features)
+    assert costs[1] > costs[0] and costs[2] > costs[0]
+    # Observed runtimes are stored for later jobs and refine the model.
+    for _ in range(20):
+        model.observe(100.0, **{name: v[0] for name, v in features.items()})
+        model.observe(1.0, **{name: v[1] for name, v in features.items()})
+    model.save()
+    later = CostModel(str(tmp_path / "cost_model.json"))
+    assert len(later.observations) == 40
+    costs = later.predict(features)
+    assert costs[0] > costs[1]
+
+
+def test_21_affinity_matrix():
+    assert receptor_references({"receptor_ref": "1/1/1"}) == ["1/1/1"]
+    assert receptor_references(
+        {"receptor_refs": ["1/2/1", "1/1/1", "1/2/1"]}
+    ) == ["1/2/1", "1/1/1"]
+    logs = [
+        dict(
+            receptor_ref=receptor_ref,
+            ligand_pdbqt_input=ligand,
+            ligand_ref="1/3/1",
+            name=ligand,
+            compound_set="set",
+            affinity=affinity,
+        )
+        for receptor_ref, ligand, affinity in [
+            ("1/2/1", "a", -7.0),
+            ("1/2/1", "a", -8.0),
+            ("1/1/1", "a", -6.0),
+            ("1/2/1", "b", -5.0),
+        ]
+    ]
+    receptor_refs, rows = affinity_matrix(logs)
+    assert receptor_refs == ["1/1/1", "1/2/1"]
+    assert [row["affinities"] for row in rows] == [[-6.0, -8.0], [None, -5.0]]
+
+
+def test_22_spool_workers(tmp_path, monkeypatch, receptor, ligands):
+    # The fake vina writes its output, failing for the second ligand.
+    fake_vina(
+        tmp_path,
+        monkeypatch,
+        'case "$*" in *49846579*) ;; *) echo "Parse error" >&2; exit 1;; '
+        'esac\nwhile [ "$#" -gt 0 ]; do case "$1" in --out|--log) '
+        'echo done > "$2";; esac; shift; done',
+    )
+    spool = Spool(str(tmp_path / "spool"))
+    workers = start_workers(spool.path, 2)
+    task_ids = [
+        spool.submit(
+            dict(
+                receptor=receptor,
+                ligand=ligand,
+                working_directory=str(tmp_path),
+                params={},
+            )
+        )
+        for ligand in ligands
+    ]
+    results = [spool.wait(task_id, poll=0.05) for task_id in task_ids]
+    spool.stop()
+    assert [worker.wait(timeout=30) for worker in workers] == [0, 0]
+    assert all(os.path.exists(path) for path in results[0]["output"])
+    assert "Parse error" in results[1]["error"]
+    assert results[0]["usage"]["child_cpu_seconds"] >= 0
+    assert not os.listdir(os.path.join(spool.path, "done"))
+    # Waiting fails, rather than hangs, once no worker is left or after the
+    # timeout.
+    task = dict(receptor=receptor, ligand=ligands[0], params={})
+    task_id = spool.submit(task)
+    with pytest.raises(SpoolError):
+        spool.wait(task_id, poll=0.05, alive=lambda: False)
+    with pytest.raises(SpoolError):
+        spool.wait(spool.submit(task), poll=0.05, timeout=0.1)
+    assert not os.listdir(os.path.join(spool.path, "pending"))
+    # Any failure of a task is reported as its error.
+    result = execute(dict(task, params={"engine": "unknown"}))
+    assert "ValueError" in result["error"]
+    # A cache which can not be opened is reported with the usage.
+    (tmp_path / "file").write_text("")
+    result = execute(
+        dict(task, cache_dir=str(tmp_path / "file"), cache_max_bytes=1)
+    )
+    assert result["error"] and result["usage"]["wall_seconds"] >= 0
+
+
+def test_23_embedded_engine(tmp_path, monkeypatch):
+    engines = []
+
+    class FakeVina:
+        def __init__(self, **kwargs):
+            self.kwargs = kwargs
+            engines.append(self)
+
+        def set_receptor(self, receptor):
+            self.receptor = receptor
+
+        def compute_vina_maps(self, center, box_size):
+            pass
+
+        def set_ligand_from_string(self, ligand):
+            self.ligand = ligand
+
+        def dock(self, **kwargs):
+            pass
+
+        def poses(self, **kwargs):
+            return (
+                f"MODEL 1\nREMARK VINA RESULT: -8.1 0.0 0.0\n{self.ligand}"
+                f"ENDMDL\nMODEL 2\nREMARK VINA RESULT: -7.5 1.2 2.5\n"
+                f"{self.ligand}ENDMDL\n"
+            )
+
+    monkeypatch.setattr(kb_ad_vina.embedded, "Vina", FakeVina)
+    assert docking_engine("python").function is run_vina_embedded
+    receptor = tmp_path / "receptor.pdbqt"
+    receptor.write_text("ATOM\n")
+    for name in ("a", "b"):
+        ligand = tmp_path / f"{name}.pdbqt"
+        ligand.write_text(f"REMARK {name}\n")
+        output, log = run_vina_embedded(
+            str(receptor), str(ligand), str(tmp_path), {}
+        )
+        with open(output) as f:
+            assert f"REMARK {name}" in f.read()
+        with open(log) as f:
+            modes = parse_vina_log(f.read())
+        assert [mode["affinity"] for mode in modes] == [-8.1, -7.5]
+        assert modes[1]["rmsd_ub"] == 2.5
+    # The receptor stays loaded between the dockings of a thread.
+    assert len(engines) == 1
+    # vina draws a random seed for 0, so a fixed seed is used and logged.
+    assert engines[0].kwargs["seed"] == 42
+    with open(log) as f:
+        assert f.readline() == "Using random seed: 42\n"
+    assert docking_cache_key(
+        str(receptor), str(ligand), {"seed": 0}
+    ) == docking_cache_key(str(receptor), str(ligand), {})
+    with pytest.raises(ValueError, match="can not be interrupted"):
+        run_vina_embedded(
+            str(receptor), str(ligand), str(tmp_path), {}, timeout=60
+        )
+    monkeypatch.setattr(kb_ad_vina.embedded, "Vina", None)
+    assert docking_engine("python").function is run_vina
+    with pytest.raises(ValueError, match="Unknown docking engine"):
+        docking_engine("ad4")
+
+
+def test_24_docking_engines(tmp_path, monkeypatch, receptor, ligands):
+    profiles = {
+        name: engine.profile() for name, engine in DOCKING_ENGINES.items()
+    }
+    assert {"cli", "python", "vinardo"} <= set(profiles)
+    assert profiles["vinardo"]["scoring"] == "vinardo"
+    assert "grid_maps" in profiles["cli"]["capabilities"]
+    assert profiles["vinardo"]["cost"]["search"] < 1.0
+    # Without the vina Python package Vinardo runs with the vina command if
+    # it is version 1.2 or later.
+    monkeypatch.setattr(kb_ad_vina.embedded, "Vina", None)
+    old = tmp_path / "old"
+    old.mkdir()
+    fake_vina(old, monkeypatch, 'echo "AutoDock Vina 1.1.2 (May 11, 2011)"')
+    assert vina_version() == (1, 1, 2)
+    with pytest.raises(ValueError, match="can not run here"):
+        docking_engine("vinardo")
+    fake_vina(
+        tmp_path,
+        monkeypatch,
+        '[ "$1" = --version ] && echo "AutoDock Vina v1.2.5" && exit 0\n'
+        'echo "$@" >&2; exit 1',
+    )
+    engine = docking_engine("vinardo")
+    assert engine.name == "vinardo_cli"
+    with pytest.raises(VinaError, match="--scoring vinardo"):
+        engine.dock(receptor, ligands[0], str(tmp_path), {})
+    with pytest.raises(VinaError) as error:
+        docking_engine().dock(receptor, ligands[0], str(tmp_path), {})
+    assert "--scoring" not in str(error.value)
+    # The results of each scoring function are kept apart.
+    vinardo = engine.parameters({})
+    assert docking_cache_key(receptor, ligands[0], {}) != docking_cache_key(
+        receptor, ligands[0], vinardo
+    )
+    assert checkpoint_key(receptor, ligands[0], ".", {}) != checkpoint_key(
+        receptor, ligands[0], ".", vinardo
+    )
+    # So are the results of each engine and version of vina.
+    python = {"engine": "python"}
+    assert docking_cache_key(receptor, ligands[0], {}) != docking_cache_key(
+        receptor, ligands[0], python
+    )
+    assert checkpoint_key(receptor, ligands[0], ".", {}) != checkpoint_key(
+        receptor, ligands[0], ".", python
+    )
+    key = docking_cache_key(receptor, ligands[0], {})
+    (tmp_path / "1.1.2").mkdir()
+    fake_vina(tmp_path / "1.1.2", monkeypatch, "echo AutoDock Vina 1.1.2")
+    assert docking_cache_key(receptor, ligands[0], {}) != key
+
+
+def test_25_docking_modes(tmp_path, monkeypatch, receptor, ligands):
+    assert parse_vina_output(VINA_LOG)[0]["affinity"] == -8.1
+    for log in (
+        "Affinity: -7.25 (kcal/mol)\nIntermolecular contributions",
+        "Estimated Free Energy of Binding   : -6.5 (kcal/mol) [=(1)+(2)]",
+    ):
+        modes = parse_vina_output(log, "score_only")
+        assert len(modes) == 1 and modes[0]["affinity"] < -6
+    assert get_affinity_from_vina_log("Affinity: -7.25", "local_only") == -7.25
+    assert search_threads({"exhaustiveness": 8, "mode": "score_only"}) == 1
+    with pytest.raises(ValueError, match="Unknown docking mode"):
+        search_threads({"mode": "rescore"})
+    # The fake vina writes the log of a score_only run, and no output.
+    fake_vina(
+        tmp_path,
+        monkeypatch,
+        'case "$*" in *--score_only*) ;; *) exit 1;; esac\n'
+        'while [ "$#" -gt 0 ]; do case "$1" in --log) '
+        'echo "Affinity: -7.25 (kcal/mol)" > "$2";; esac; shift; done',
+    )
+    params = {"mode": "score_only"}
+    output, log = run_vina(receptor, ligands[0], str(tmp_path), params)
+    with open(output) as f, open(ligands[0]) as g:
+        assert f.read() == g.read()
+    with open(log) as f:
+        modes = parse_vina_output(f.read(), "score_only")
+    assert modes[0]["affinity"] == -7.25
+    # Scores are kept apart from the results of dockings.
+    assert docking_cache_key(receptor, ligands[0], {}) != docking_cache_key(
+        receptor, ligands[0], params
+    )
+
+
+def test_26_vina_timeout_not_retried(tmp_path, monkeypatch, app, receptor):
+    fake_vina(tmp_path, monkeypatch, SLOW_VINA)
+    ligand = os.path.join(app.ligands_input_shared, "_w1o2v1_m0.sdf.pdbqt")
+    os.makedirs(app.ligands_input_shared, exist_ok=True)
+    open(ligand, "w").close()
+    params = {"vina_timeout": 0.5, "vina_retries": 2}
+    start = time.monotonic()
+    assert app.run_vina(receptor, ligand, params) is None
+    # A docking which timed out is not rerun.
+    assert time.monotonic() - start < 5
+    assert app.failures[0]["attempts"] == 1
+    assert "within 0.5 seconds" in app.failures[0]["error"]
+
+
+def test_27_duplicate_ligands(monkeypatch, app):
+    docked = []
+
+    def dock(receptor, ligand, working_directory, params, **kwargs):
+        docked.append(ligand)
+        output, log = vina_output_paths(receptor, ligand, working_directory)
+        with open(output, "w") as f:
+            f.write(VINA_PDBQT)
+        with open(log, "w") as f:
+            f.write(VINA_LOG)
+        return output, log
+
+    monkeypatch.setattr(DOCKING_ENGINES["cli"], "function", dock)
+    monkeypatch.setattr(app, "get_vina_citation", lambda params: "")
+    monkeypatch.setattr(
+        app, "create_report_from_template", lambda path, config: config
+    )
+    # Both compound sets hold the same two molecules: one is docked once
+    # and the other, with 62 heavy atoms, skipped once.
+    report = app.do_analysis(
+        dict(
+            ligand_refs=["1/2/1", "1/3/1"],
+            receptor_ref="1/1/1",
+            workspace_name="workspace",
+            exhaustiveness=1,
+            filter_max_heavy_atoms=61,
+        )
+    )
+    assert len(docked) == 1
+    template_variables = report["template_variables"]
+    rows = template_variables["affinity_matrix"]
+    assert sorted(
+        (row["compound_set"], row["ligand_ref"]) for row in rows
+    ) == [
+        ("CompoundSet 1/2/1", "1/2/1"),
+        ("CompoundSet 1/3/1", "1/3/1"),
+    ]
+    assert all(row["name"] == "49846579" for row in rows)
+    assert all(row["affinities"] == [-8.1] for row in rows)
+    # The duplicate gets a log of its own, naming its compound set.
+    logs = template_variables["logs"]
+    assert sorted(logdata["ligand_ref"] for logdata in logs.values()) == [
+        "1/2/1",
+        "1/3/1",
+    ]
+    assert len({os.path.split(log)[1] for log in logs}) == 2
+    assert all(os.path.exists(log) for log in logs)
+    assert sorted(
+        (record["compound_set"], record["ligand_ref"], record["name"])
+        for record in app.skipped
+    ) == [
+        ("CompoundSet 1/2/1", "1/2/1", "139024764"),
+        ("CompoundSet 1/3/1", "1/3/1", "139024764"),
+    ]
+
+
+def test_28_receptor_cache(tmp_path, monkeypatch, app):
+    receptor = app.prepare_receptor(app.download_receptor("1/1/1"))
+    with open(receptor, "rb") as f:
+        prepared = f.read()
+    # A later job with the same cache neither downloads nor converts the
+    # receptor again.
+    second = make_app(tmp_path, "second")
+
+    def fail(*args, **kwargs):
+        raise AssertionError("the receptor was not served from the cache")
+
+    monkeypatch.setattr(second.psu, "export_pdb_structures", fail)
+    monkeypatch.setattr(kb_ad_vina.utils, "receptor_as_pdbqt", fail)
+    receptor = second.prepare_receptor(second.download_receptor("1/1/1"))
+    assert receptor.startswith(second.reports_path)
+    with open(receptor, "rb") as f:
+        assert f.read() == prepared
+    assert second.receptor_filenames["1/1/1"] == os.path.split(receptor)[1]
+    with open(second.cached_receptor("1/1/1")["metadata.json"]) as f:
+        metadata = json.load(f)
+    assert metadata["receptor_ref"] == "1/1/1"
+    assert metadata["pdbqt_bytes"] == len(prepared)
+    # The receptor cache gets a share of the cache budget.
+    assert second.receptor_cache.max_bytes < second.cache_max_bytes
+
+
+def test_29_receptor_conversion_errors(tmp_path, monkeypatch, app):
+    bad = tmp_path / "_w1o9v1_.pdb"
+    bad.write_text("HEADER    NOT A STRUCTURE\n")
+    with pytest.raises(ConversionError):
+        receptor_as_pdbqt(str(bad))
+    assert not os.path.exists(f"{bad}qt")
+    # obabel writes nothing for it either.
+    monkeypatch.setattr(kb_ad_vina.utils, "openbabel", None)
+    with pytest.raises(ConversionError, match="No atoms"):
+        receptor_as_pdbqt(str(bad))
+    # A receptor which fails to convert is not cached.
+    with pytest.raises(ConversionError):
+        app.receptor_as_pdbqt(str(bad))
+    assert app.cached_receptor("1/9/1") is None
+    empty = tmp_path / "empty.pdbqt"
+    empty.write_text("")
+    app.cache_receptor("1/9/1", str(bad), str(empty))
+    assert app.cached_receptor("1/9/1") is None
+
+
+# A fake vina 1.2, which rejects --log, writes maps when asked to and the
+# table of binding modes of VINA_LOG to its standard output, recording its
+# arguments in calls.
+VINA_1_2 = (
+    '[ "$1" = --version ] && echo "AutoDock Vina v1.2.5" && exit 0\n'
+    'echo "$@" >> "$(dirname "$0")/calls"\n'
+    'case "$*" in *--log*) echo "unknown option log" >&2; exit 1;; esac\n'
+    "for arg; do last=$arg; done\n"
+    'case "$*" in *--write_maps*) touch "$last.C_H.map"; exit 0;; esac\n'
+    'while [ "$#" -gt 0 ]; do case "$1" in --out) echo MODEL > "$2";; '
+    "esac; shift; done\n"
+    f"cat << EOF\n{VINA_LOG}EOF"
+)
+
+
+def test_30_vina_1_2_command(tmp_path, monkeypatch, app, receptor):
+    fake_vina(tmp_path, monkeypatch, VINA_1_2)
+    ligand = os.path.join(app.ligands_input_shared, "_w1o2v1_m0.sdf.pdbqt")
+    open(ligand, "w").close()
+    # The log of vina 1.2 is its standard output.
+    for engine in ("cli", "vinardo_cli"):
+        output = app.run_vina(receptor, ligand, {"engine": engine})
+        assert output is not None
+        with open(output[1]) as f:
+            assert parse_vina_log(f.read())[0]["affinity"] == -8.1
+    assert not app.failures
+
+
+def test_31_reuse_maps_vina_1_2(tmp_path, monkeypatch, app, receptor):
+    fake_vina(tmp_path, monkeypatch, VINA_1_2)
+    ligand = os.path.join(app.ligands_input_shared, "_w1o2v1_m0.sdf.pdbqt")
+    open(ligand, "w").close()
+    for engine in ("cli", "vinardo_cli"):
+        params = {"engine": engine, "reuse_maps": 1}
+        output = app.run_vina(receptor, ligand, params)
+        assert output is not None
+        with open(output[1]) as f:
+            assert parse_vina_log(f.read())[0]["affinity"] == -8.1
+    assert not app.failures
+    with open(tmp_path / "bin" / "calls") as f:
+        calls = f.read().splitlines()
+    # Each scoring function gets its maps, which its dockings load.
+    assert sum("--write_maps" in call for call in calls) == 2
+    assert sum("--maps" in call for call in calls) == 2
+
+
+def test_32_in_process_cpus(monkeypatch, app):
+    monkeypatch.setattr(kb_ad_vina.embedded, "Vina", object)
+    params = {"max_cpus": 32, "exhaustiveness": 8}
+    assert app.docking_cpus(500, params) == (32, 1)
+    # vina holds the GIL, so dockings in process run one at a time on all
+    # the threads vina can use.
+    params["engine"] = "python"
+    assert app.docking_cpus(500, params) == (1, 8)
+    # The workers of a spool are processes of their own.
+    monkeypatch.setattr(app, "spool", object())
+    assert app.docking_cpus(500, params) == (32, 1)
+
+
+def test_33_refine(monkeypatch, app):
+    app.sites = {
+        "1/2/3": {"pocket1": {"center_x": 1.0}, "pocket2": {"center_x": 2.0}}
+    }
+    affinities = {
+        ("a", "pocket1"): -9.0,
+        ("a", "pocket2"): -8.5,
+        ("b", "pocket2"): -7.0,
+        ("c", "pocket1"): -6.0,
+    }
+    results = [
+        (
+            None,
+            None,
+            dict(
+                affinity=affinity,
+                receptor_ref="1/2/3",
+                site=site,
+                ligand_pdbqt_input=ligand,
+            ),
+        )
+        for (ligand, site), affinity in affinities.items()
+    ]
+    dockings = []
+
+    def run_dockings(batch):
+        dockings.extend(batch)
+        return [None] * len(batch)
+
+    monkeypatch.setattr(app, "run_dockings", run_dockings)
+    app.refine({"1/2/3": "receptor.pdbqt"}, results, {"screen_top_k": 2})
+    # The best two distinct ligands are docked again at their best site, in
+    # one batch.
+    assert [
+        (os.path.split(ligand)[1], params["center_x"])
+        for _, ligand, params, _ in dockings
+    ] == [("a", 1.0), ("b", 2.0)]
+    assert [logdata["refined"] for _, _, logdata in results] == [
+        True,
+        False,
+        True,
+        False,
+    ]
+
+
+def test_34_vina_citation(monkeypatch, app):
+    # The citation of the engines in process does not need the vina command.
+    monkeypatch.setenv("PATH", "")
+    monkeypatch.setattr(kb_ad_vina.embedded, "Vina", object)
+    citation = app.get_vina_citation({"engine": "python"})
+    assert "10.1021/acs.jcim.1c00203" in citation